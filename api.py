@@ -5,6 +5,9 @@ from troposphere import Output, Ref, apigateway, GetAtt, ssm
 class Stocks(Blueprint):
     VARIABLES = {"env-dict": {"type": dict}}
 
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
     def create_api_gateway(self):
         self.api = apigateway.RestApi(
             "StocksApi",
@@ -40,7 +43,7 @@ class Stocks(Blueprint):
     def store_ssm_parameters(self):
         ssm_api_id = ssm.Parameter(
             "StocksApiId",
-            Name="/stocks/api/id",
+            Name=self.ssm_path("/api/id"),
             Type="String",
             Value=Ref(self.api),
         )
@@ -48,7 +51,7 @@ class Stocks(Blueprint):
 
         ssm_api_parent_resource_id = ssm.Parameter(
             "StocksApiParentResourceId",
-            Name="/stocks/api/parent/resource/id",
+            Name=self.ssm_path("/api/parent/resource/id"),
             Type="String",
             Value=GetAtt(self.api, "RootResourceId"),
         )
@@ -56,7 +59,7 @@ class Stocks(Blueprint):
 
         ssm_webhook_resource_id = ssm.Parameter(
             "WebhookResourceId",
-            Name="/stocks/webhook/resource/id",
+            Name=self.ssm_path("/webhook/resource/id"),
             Type="String",
             Value=Ref(self.webhook_api_resource),
         )
@@ -64,7 +67,7 @@ class Stocks(Blueprint):
 
         ssm_sync_resource_id = ssm.Parameter(
             "SyncResourceId",
-            Name="/stocks/sync/resource/id",
+            Name=self.ssm_path("/sync/resource/id"),
             Type="String",
             Value=Ref(self.sync_api_resource),
         )
@@ -0,0 +1,512 @@
+import json
+
+from stacker.blueprints.base import Blueprint
+from troposphere import (
+    Output,
+    Ref,
+    GetAtt,
+    Parameter,
+    Sub,
+    batch,
+    ecr,
+    iam,
+    logs,
+    scheduler,
+    sqs,
+    ssm,
+)
+
+
+class Stocks(Blueprint):
+    VARIABLES = {"env-dict": {"type": dict}}
+
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
+    def resolve_ssm(self, path):
+        return "{{resolve:ssm:%s}}" % self.ssm_path(path)
+
+    def get_batch_network(self):
+        # Fargate tasks run in the cache stack's private subnets. That stack
+        # needs NatGateway: true so tasks can pull images from ECR.
+        self.batch_subnet_ids = self.template.add_parameter(
+            Parameter(
+                "BatchSubnetIds",
+                Type="AWS::SSM::Parameter::Value<List<AWS::EC2::Subnet::Id>>",
+                Default=self.ssm_path("/cache/subnet/ids"),
+            )
+        )
+        self.batch_security_group_id = self.template.add_parameter(
+            Parameter(
+                "BatchSecurityGroupId",
+                Type="AWS::SSM::Parameter::Value<AWS::EC2::SecurityGroup::Id>",
+                Default=self.ssm_path("/cache/lambda/security/group/id"),
+            )
+        )
+
+    def get_rate_limiter(self):
+        self.rate_limiter_table_arn = self.template.add_parameter(
+            Parameter(
+                "RateLimiterTableArn",
+                Type="AWS::SSM::Parameter::Value<String>",
+                Default=self.ssm_path("/rate/limiter/table/arn"),
+            )
+        )
+
+    def get_schedule_retry_policy(self, title, default_attempts=3, default_age=3600):
+        retry_policy = self.get_variables()["env-dict"].get(
+            "ScheduleRetryPolicies", {}
+        ).get(title, {})
+        return scheduler.RetryPolicy(
+            MaximumEventAgeInSeconds=retry_policy.get(
+                "MaximumEventAgeInSeconds", default_age
+            ),
+            MaximumRetryAttempts=retry_policy.get(
+                "MaximumRetryAttempts", default_attempts
+            ),
+        )
+
+    def create_batch_repository(self):
+        self.batch_repository = self.template.add_resource(
+            ecr.Repository(
+                "StocksBatchRepository",
+                RepositoryName=self.get_variables()["env-dict"].get(
+                    "BatchRepositoryName",
+                    "stocks-batch" + self.get_variables()["env-dict"].get("NameSuffix", ""),
+                ),
+                ImageScanningConfiguration=ecr.ImageScanningConfiguration(
+                    ScanOnPush=True
+                ),
+                LifecyclePolicy=ecr.LifecyclePolicy(
+                    LifecyclePolicyText=json.dumps(
+                        {
+                            "rules": [
+                                {
+                                    "rulePriority": 1,
+                                    "description": "Expire untagged images",
+                                    "selection": {
+                                        "tagStatus": "untagged",
+                                        "countType": "sinceImagePushed",
+                                        "countUnit": "days",
+                                        "countNumber": 7,
+                                    },
+                                    "action": {"type": "expire"},
+                                }
+                            ]
+                        }
+                    )
+                ),
+            )
+        )
+
+    def create_batch_roles(self):
+        self.batch_log_group = self.template.add_resource(
+            logs.LogGroup(
+                "StocksBatchLogGroup",
+                LogGroupName="/aws/batch/stocks"
+                + self.get_variables()["env-dict"].get("NameSuffix", ""),
+                RetentionInDays=self.get_variables()["env-dict"].get(
+                    "BatchLogRetentionDays", 30
+                ),
+            )
+        )
+
+        self.batch_execution_role = self.template.add_resource(
+            iam.Role(
+                "StocksBatchExecutionRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "ecs-tasks.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                        }
+                    ],
+                },
+                ManagedPolicyArns=[
+                    Sub(
+                        "arn:${AWS::Partition}:iam::aws:policy/service-role/AmazonECSTaskExecutionRolePolicy"
+                    )
+                ],
+            )
+        )
+
+        self.batch_job_role = self.template.add_resource(
+            iam.Role(
+                "StocksBatchJobRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "ecs-tasks.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName="StocksBatchJobS3Policy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["s3:GetObject"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:s3:::${BucketName}/*",
+                                            BucketName=self.get_variables()["env-dict"][
+                                                "BucketName"
+                                            ],
+                                        )
+                                    ],
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["s3:ListBucket"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:s3:::${BucketName}",
+                                            BucketName=self.get_variables()["env-dict"][
+                                                "BucketName"
+                                            ],
+                                        )
+                                    ],
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["s3:PutObject"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:s3:::${BucketName}/batch/*",
+                                            BucketName=self.get_variables()["env-dict"][
+                                                "BucketName"
+                                            ],
+                                        )
+                                    ],
+                                },
+                            ],
+                        },
+                    ),
+                    iam.Policy(
+                        PolicyName="StocksBatchJobSecretsManagerPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["secretsmanager:GetSecretValue"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
+                                            SecretId=self.get_variables()["env-dict"][
+                                                "SharedSecretsId"
+                                            ],
+                                        )
+                                    ],
+                                }
+                            ],
+                        },
+                    ),
+                ],
+            )
+        )
+
+        # Jobs call the same broker account as the Lambdas, so they draw from
+        # the shared rate limiter rather than a budget of their own.
+        if self.get_variables()["env-dict"].get("RateLimiterEnabled", False):
+            self.batch_job_role.Policies.append(
+                iam.Policy(
+                    PolicyName="StocksBatchJobRateLimiterPolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "dynamodb:GetItem",
+                                    "dynamodb:PutItem",
+                                    "dynamodb:UpdateItem",
+                                ],
+                                "Resource": [Ref(self.rate_limiter_table_arn)],
+                            }
+                        ],
+                    },
+                )
+            )
+
+    def create_batch_job_queue(self):
+        compute_environment_order = []
+        capacity_types = ["FARGATE_SPOT"]
+        if self.get_variables()["env-dict"].get("BatchOnDemandFallback", False):
+            capacity_types.append("FARGATE")
+
+        # Spot capacity is tried first; on-demand Fargate only takes jobs Spot
+        # cannot place when BatchOnDemandFallback is set.
+        for order, capacity_type in enumerate(capacity_types, start=1):
+            compute_environment = self.template.add_resource(
+                batch.ComputeEnvironment(
+                    f"StocksBatch{capacity_type.title().replace('_', '')}ComputeEnvironment",
+                    Type="MANAGED",
+                    State="ENABLED",
+                    ComputeResources=batch.ComputeResources(
+                        Type=capacity_type,
+                        MaxvCpus=self.get_variables()["env-dict"].get(
+                            "BatchMaxvCpus", 256
+                        ),
+                        Subnets=Ref(self.batch_subnet_ids),
+                        SecurityGroupIds=[Ref(self.batch_security_group_id)],
+                    ),
+                )
+            )
+            compute_environment_order.append(
+                batch.ComputeEnvironmentOrder(
+                    ComputeEnvironment=Ref(compute_environment),
+                    Order=order,
+                )
+            )
+
+        self.batch_job_queue = self.template.add_resource(
+            batch.JobQueue(
+                "StocksBatchJobQueue",
+                JobQueueName=self.get_variables()["env-dict"].get(
+                    "BatchJobQueueName",
+                    "stocks-batch" + self.get_variables()["env-dict"].get("NameSuffix", ""),
+                ),
+                Priority=1,
+                State="ENABLED",
+                ComputeEnvironmentOrder=compute_environment_order,
+            )
+        )
+
+        self.template.add_resource(
+            ssm.Parameter(
+                "BatchJobQueueArnParameter",
+                Name=self.ssm_path("/batch/job/queue/arn"),
+                Type="String",
+                Value=Ref(self.batch_job_queue),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "BatchJobQueueArn",
+                Value=Ref(self.batch_job_queue),
+            )
+        )
+
+    def create_batch_job_definitions(self):
+        self.batch_job_definitions = {}
+        for job in self.get_variables()["env-dict"].get("BatchJobs", []):
+            job_id = "".join(part.title() for part in job["Name"].split("-"))
+
+            # Array jobs share this definition. Batch only tells each child its
+            # AWS_BATCH_JOB_ARRAY_INDEX, so ARRAY_SIZE is passed alongside it to
+            # let the child work out its slice of SYMBOLS_KEY. Submitters using
+            # a different size override ARRAY_SIZE in ContainerOverrides.
+            job_environment = {
+                "BUCKET_NAME": self.get_variables()["env-dict"]["BucketName"],
+                "SHARED_SECRETS": self.get_variables()["env-dict"]["SharedSecretsId"],
+                "RESULTS_PREFIX": f"batch/{job['Name']}/",
+                "ARRAY_SIZE": str(job.get("ArraySize", 1)),
+            }
+            if "SymbolsKey" in job:
+                job_environment["SYMBOLS_KEY"] = job["SymbolsKey"]
+            if self.get_variables()["env-dict"].get("RateLimiterEnabled", False):
+                job_environment["RATE_LIMITER_TABLE"] = self.resolve_ssm(
+                    "/rate/limiter/table/name"
+                )
+                job_environment["RATE_LIMITER_BUCKETS"] = self.resolve_ssm(
+                    "/rate/limiter/buckets"
+                )
+
+            job_definition = self.template.add_resource(
+                batch.JobDefinition(
+                    f"{job_id}JobDefinition",
+                    JobDefinitionName=job["Name"]
+                    + self.get_variables()["env-dict"].get("NameSuffix", ""),
+                    Type="container",
+                    PlatformCapabilities=["FARGATE"],
+                    PropagateTags=True,
+                    RetryStrategy=batch.RetryStrategy(
+                        Attempts=job.get("Attempts", 3),
+                    ),
+                    Timeout=batch.Timeout(
+                        AttemptDurationSeconds=job.get("TimeoutSeconds", 14400),
+                    ),
+                    ContainerProperties=batch.ContainerProperties(
+                        Image=Sub(
+                            "${RepositoryUri}:${ImageTag}",
+                            RepositoryUri=GetAtt(self.batch_repository, "RepositoryUri"),
+                            ImageTag=job.get("ImageTag", "latest"),
+                        ),
+                        Command=job["Command"],
+                        JobRoleArn=GetAtt(self.batch_job_role, "Arn"),
+                        ExecutionRoleArn=GetAtt(self.batch_execution_role, "Arn"),
+                        ResourceRequirements=[
+                            batch.ResourceRequirement(
+                                Type="VCPU", Value=str(job.get("Vcpu", 1))
+                            ),
+                            batch.ResourceRequirement(
+                                Type="MEMORY", Value=str(job.get("Memory", 2048))
+                            ),
+                        ],
+                        Environment=[
+                            batch.Environment(Name=name, Value=value)
+                            for name, value in job_environment.items()
+                        ],
+                        NetworkConfiguration=batch.NetworkConfiguration(
+                            AssignPublicIp="DISABLED"
+                        ),
+                        FargatePlatformConfiguration=batch.FargatePlatformConfiguration(
+                            PlatformVersion="LATEST"
+                        ),
+                        LogConfiguration=batch.LogConfiguration(
+                            LogDriver="awslogs",
+                            Options={
+                                "awslogs-group": Ref(self.batch_log_group),
+                                "awslogs-region": Ref("AWS::Region"),
+                                "awslogs-stream-prefix": job["Name"],
+                            },
+                        ),
+                    ),
+                )
+            )
+            self.batch_job_definitions[job["Name"]] = job_definition
+
+            self.template.add_resource(
+                ssm.Parameter(
+                    f"{job_id}JobDefinitionArnParameter",
+                    Name=self.ssm_path(f"/batch/job/definition/{job['Name']}/arn"),
+                    Type="String",
+                    Value=Ref(job_definition),
+                )
+            )
+
+    def create_batch_schedulers(self):
+        scheduled_jobs = [
+            job
+            for job in self.get_variables()["env-dict"].get("BatchJobs", [])
+            if "ScheduleExpression" in job
+        ]
+        if not scheduled_jobs:
+            return
+
+        scheduler_execution_role = self.template.add_resource(
+            iam.Role(
+                "BatchSchedulerExecutionRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "scheduler.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName="BatchSchedulerExecutionPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["batch:SubmitJob", "batch:TagResource"],
+                                    "Resource": [
+                                        Ref(self.batch_job_queue),
+                                        Sub(
+                                            "arn:aws:batch:${AWS::Region}:${AWS::AccountId}:job-definition/*"
+                                        ),
+                                        Sub(
+                                            "arn:aws:batch:${AWS::Region}:${AWS::AccountId}:job/*"
+                                        ),
+                                    ],
+                                },
+                            ],
+                        },
+                    )
+                ],
+            )
+        )
+
+        dead_letter_queue = self.template.add_resource(
+            sqs.Queue(
+                "BatchSchedulerDeadLetterQueue",
+                MessageRetentionPeriod=1209600,
+                SqsManagedSseEnabled=True,
+            )
+        )
+        scheduler_execution_role.Policies.append(
+            iam.Policy(
+                PolicyName="BatchSchedulerDeadLetterQueuePolicy",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": ["sqs:SendMessage"],
+                            "Resource": [GetAtt(dead_letter_queue, "Arn")],
+                        },
+                    ],
+                },
+            )
+        )
+
+        for job in scheduled_jobs:
+            job_id = "".join(part.title() for part in job["Name"].split("-"))
+
+            submit_job = {
+                "JobName": job["Name"],
+                "JobQueue": "${JobQueueArn}",
+                "JobDefinition": "${JobDefinitionArn}",
+            }
+            if job.get("ArraySize", 0) > 1:
+                submit_job["ArrayProperties"] = {"Size": job["ArraySize"]}
+
+            self.template.add_resource(
+                scheduler.Schedule(
+                    f"{job_id}BatchScheduler",
+                    Name=f"{job['Name']}-scheduler"
+                    + self.get_variables()["env-dict"].get("NameSuffix", ""),
+                    Description=f"Submit the {job['Name']} batch job",
+                    ScheduleExpression=job["ScheduleExpression"],
+                    ScheduleExpressionTimezone=job.get(
+                        "ScheduleExpressionTimezone", "America/Los_Angeles"
+                    ),
+                    FlexibleTimeWindow=scheduler.FlexibleTimeWindow(
+                        Mode="FLEXIBLE", MaximumWindowInMinutes=15
+                    ),
+                    Target=scheduler.Target(
+                        Arn="arn:aws:scheduler:::aws-sdk:batch:submitJob",
+                        Input=Sub(
+                            json.dumps(submit_job),
+                            JobQueueArn=Ref(self.batch_job_queue),
+                            JobDefinitionArn=Ref(
+                                self.batch_job_definitions[job["Name"]]
+                            ),
+                        ),
+                        RetryPolicy=self.get_schedule_retry_policy(
+                            f"{job_id}BatchScheduler"
+                        ),
+                        DeadLetterConfig=scheduler.DeadLetterConfig(
+                            Arn=GetAtt(dead_letter_queue, "Arn")
+                        ),
+                        RoleArn=GetAtt(scheduler_execution_role, "Arn"),
+                    ),
+                )
+            )
+
+    def create_template(self):
+        self.get_batch_network()
+        if self.get_variables()["env-dict"].get("RateLimiterEnabled", False):
+            self.get_rate_limiter()
+        self.create_batch_repository()
+        self.create_batch_roles()
+        self.create_batch_job_queue()
+        self.create_batch_job_definitions()
+        self.create_batch_schedulers()
+        return self.template
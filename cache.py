@@ -0,0 +1,413 @@
+from stacker.blueprints.base import Blueprint
+from troposphere import (
+    Output,
+    Ref,
+    GetAtt,
+    GetAZs,
+    Select,
+    Cidr,
+    Join,
+    Sub,
+    ec2,
+    efs,
+    elasticache,
+    ssm,
+)
+
+
+class Stocks(Blueprint):
+    VARIABLES = {"env-dict": {"type": dict}}
+
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
+    def create_vpc(self):
+        self.vpc = self.template.add_resource(
+            ec2.VPC(
+                "StocksVpc",
+                CidrBlock=self.get_variables()["env-dict"].get(
+                    "VpcCidr", "10.20.0.0/16"
+                ),
+                EnableDnsHostnames=True,
+                EnableDnsSupport=True,
+            )
+        )
+
+        self.private_subnets = []
+        self.private_route_tables = []
+        for index in range(2):
+            private_route_table = self.template.add_resource(
+                ec2.RouteTable(
+                    f"StocksPrivateRouteTable{index + 1}",
+                    VpcId=Ref(self.vpc),
+                )
+            )
+            private_subnet = self.template.add_resource(
+                ec2.Subnet(
+                    f"StocksPrivateSubnet{index + 1}",
+                    VpcId=Ref(self.vpc),
+                    AvailabilityZone=Select(index, GetAZs("")),
+                    CidrBlock=Select(index, Cidr(GetAtt(self.vpc, "CidrBlock"), 4, 12)),
+                    MapPublicIpOnLaunch=False,
+                )
+            )
+            self.template.add_resource(
+                ec2.SubnetRouteTableAssociation(
+                    f"StocksPrivateSubnet{index + 1}RouteTableAssociation",
+                    RouteTableId=Ref(private_route_table),
+                    SubnetId=Ref(private_subnet),
+                )
+            )
+            self.private_subnets.append(private_subnet)
+            self.private_route_tables.append(private_route_table)
+
+        self.lambda_security_group = self.template.add_resource(
+            ec2.SecurityGroup(
+                "StocksLambdaSecurityGroup",
+                GroupDescription="Stocks Lambda functions",
+                VpcId=Ref(self.vpc),
+            )
+        )
+
+    def create_nat_gateways(self):
+        # The broker API is outside AWS, so every in-VPC function reaches it
+        # through NAT. One NAT gateway per AZ keeps the order path up when an
+        # AZ fails; NatGatewayPerAz: false shares a single gateway in the
+        # first AZ, which is cheaper but makes that AZ a single point of
+        # failure for both subnets.
+        internet_gateway = self.template.add_resource(
+            ec2.InternetGateway("StocksInternetGateway")
+        )
+        self.template.add_resource(
+            ec2.VPCGatewayAttachment(
+                "StocksInternetGatewayAttachment",
+                InternetGatewayId=Ref(internet_gateway),
+                VpcId=Ref(self.vpc),
+            )
+        )
+
+        public_route_table = self.template.add_resource(
+            ec2.RouteTable(
+                "StocksPublicRouteTable",
+                VpcId=Ref(self.vpc),
+            )
+        )
+        self.template.add_resource(
+            ec2.Route(
+                "StocksPublicInternetRoute",
+                DependsOn="StocksInternetGatewayAttachment",
+                RouteTableId=Ref(public_route_table),
+                DestinationCidrBlock="0.0.0.0/0",
+                GatewayId=Ref(internet_gateway),
+            )
+        )
+
+        if self.get_variables()["env-dict"].get("NatGatewayPerAz", True):
+            nat_gateway_count = len(self.private_subnets)
+        else:
+            nat_gateway_count = 1
+
+        nat_gateways = []
+        for index in range(nat_gateway_count):
+            public_subnet = self.template.add_resource(
+                ec2.Subnet(
+                    f"StocksPublicSubnet{index + 1}",
+                    VpcId=Ref(self.vpc),
+                    AvailabilityZone=Select(index, GetAZs("")),
+                    CidrBlock=Select(
+                        index + 2, Cidr(GetAtt(self.vpc, "CidrBlock"), 4, 12)
+                    ),
+                    MapPublicIpOnLaunch=True,
+                )
+            )
+            self.template.add_resource(
+                ec2.SubnetRouteTableAssociation(
+                    f"StocksPublicSubnet{index + 1}RouteTableAssociation",
+                    RouteTableId=Ref(public_route_table),
+                    SubnetId=Ref(public_subnet),
+                )
+            )
+
+            nat_eip = self.template.add_resource(
+                ec2.EIP(
+                    f"StocksNatEip{index + 1}",
+                    DependsOn="StocksInternetGatewayAttachment",
+                    Domain="vpc",
+                )
+            )
+            nat_gateways.append(
+                self.template.add_resource(
+                    ec2.NatGateway(
+                        f"StocksNatGateway{index + 1}",
+                        AllocationId=GetAtt(nat_eip, "AllocationId"),
+                        SubnetId=Ref(public_subnet),
+                    )
+                )
+            )
+
+        for index, private_route_table in enumerate(self.private_route_tables):
+            self.template.add_resource(
+                ec2.Route(
+                    f"StocksPrivateNatRoute{index + 1}",
+                    RouteTableId=Ref(private_route_table),
+                    DestinationCidrBlock="0.0.0.0/0",
+                    NatGatewayId=Ref(nat_gateways[index % len(nat_gateways)]),
+                )
+            )
+
+    def create_vpc_endpoints(self):
+        endpoint_security_group = self.template.add_resource(
+            ec2.SecurityGroup(
+                "StocksEndpointSecurityGroup",
+                GroupDescription="Stocks interface VPC endpoints",
+                VpcId=Ref(self.vpc),
+                SecurityGroupIngress=[
+                    ec2.SecurityGroupRule(
+                        IpProtocol="tcp",
+                        FromPort=443,
+                        ToPort=443,
+                        SourceSecurityGroupId=Ref(self.lambda_security_group),
+                    )
+                ],
+            )
+        )
+
+        # Secrets Manager, S3 and DynamoDB are always reached privately. Add
+        # kinesis-streams (SignalStreamName), events (SignalBusName) or ssm to
+        # InterfaceEndpoints and s3express (HotDataBucketName) to
+        # GatewayEndpoints when those features are on, or the calls fail
+        # without a NAT gateway.
+        interface_endpoints = ["secretsmanager"] + [
+            service
+            for service in self.get_variables()["env-dict"].get(
+                "InterfaceEndpoints", []
+            )
+            if service != "secretsmanager"
+        ]
+        for service in interface_endpoints:
+            service_id = "".join(part.title() for part in service.split("-"))
+            self.template.add_resource(
+                ec2.VPCEndpoint(
+                    "StocksSecretsManagerEndpoint"
+                    if service == "secretsmanager"
+                    else f"Stocks{service_id}Endpoint",
+                    VpcId=Ref(self.vpc),
+                    VpcEndpointType="Interface",
+                    ServiceName=Sub(f"com.amazonaws.${{AWS::Region}}.{service}"),
+                    PrivateDnsEnabled=True,
+                    SubnetIds=[Ref(subnet) for subnet in self.private_subnets],
+                    SecurityGroupIds=[Ref(endpoint_security_group)],
+                )
+            )
+
+        gateway_endpoints = ["s3", "dynamodb"] + [
+            service
+            for service in self.get_variables()["env-dict"].get("GatewayEndpoints", [])
+            if service not in ["s3", "dynamodb"]
+        ]
+        for service in gateway_endpoints:
+            self.template.add_resource(
+                ec2.VPCEndpoint(
+                    f"Stocks{service.title()}Endpoint",
+                    VpcId=Ref(self.vpc),
+                    VpcEndpointType="Gateway",
+                    ServiceName=Sub(f"com.amazonaws.${{AWS::Region}}.{service}"),
+                    RouteTableIds=[
+                        Ref(route_table) for route_table in self.private_route_tables
+                    ],
+                )
+            )
+
+    def create_serverless_cache(self):
+        cache_security_group = self.template.add_resource(
+            ec2.SecurityGroup(
+                "StocksCacheSecurityGroup",
+                GroupDescription="Stocks serverless cache",
+                VpcId=Ref(self.vpc),
+                SecurityGroupIngress=[
+                    ec2.SecurityGroupRule(
+                        IpProtocol="tcp",
+                        FromPort=6379,
+                        ToPort=6380,
+                        SourceSecurityGroupId=Ref(self.lambda_security_group),
+                    )
+                ],
+            )
+        )
+
+        self.serverless_cache = self.template.add_resource(
+            elasticache.ServerlessCache(
+                "StocksServerlessCache",
+                ServerlessCacheName=self.get_variables()["env-dict"]["CacheName"],
+                Description="Shared quote, bar and position cache",
+                Engine=self.get_variables()["env-dict"].get("CacheEngine", "valkey"),
+                MajorEngineVersion=self.get_variables()["env-dict"].get(
+                    "CacheMajorEngineVersion", "8"
+                ),
+                SubnetIds=[Ref(subnet) for subnet in self.private_subnets],
+                SecurityGroupIds=[Ref(cache_security_group)],
+                CacheUsageLimits=elasticache.CacheUsageLimits(
+                    DataStorage=elasticache.DataStorage(
+                        Maximum=self.get_variables()["env-dict"].get(
+                            "CacheMaxDataStorageGB", 5
+                        ),
+                        Unit="GB",
+                    ),
+                    ECPUPerSecond=elasticache.ECPUPerSecond(
+                        Maximum=self.get_variables()["env-dict"].get(
+                            "CacheMaxECPUPerSecond", 10000
+                        ),
+                    ),
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "CacheEndpoint",
+                Value=Join(
+                    ":",
+                    [
+                        GetAtt(self.serverless_cache, "Endpoint.Address"),
+                        GetAtt(self.serverless_cache, "Endpoint.Port"),
+                    ],
+                ),
+            )
+        )
+
+    def create_file_system(self):
+        file_system_security_group = self.template.add_resource(
+            ec2.SecurityGroup(
+                "StocksFileSystemSecurityGroup",
+                GroupDescription="Stocks historical data file system",
+                VpcId=Ref(self.vpc),
+                SecurityGroupIngress=[
+                    ec2.SecurityGroupRule(
+                        IpProtocol="tcp",
+                        FromPort=2049,
+                        ToPort=2049,
+                        SourceSecurityGroupId=Ref(self.lambda_security_group),
+                    )
+                ],
+            )
+        )
+
+        # Elastic throughput scales with the nightly jobs reading bulk history
+        # without paying for provisioned throughput the rest of the day.
+        self.file_system = self.template.add_resource(
+            efs.FileSystem(
+                "StocksFileSystem",
+                Encrypted=True,
+                PerformanceMode="generalPurpose",
+                ThroughputMode="elastic",
+                LifecyclePolicies=[
+                    efs.LifecyclePolicy(
+                        TransitionToIA=self.get_variables()["env-dict"].get(
+                            "FileSystemTransitionToIA", "AFTER_30_DAYS"
+                        )
+                    ),
+                    efs.LifecyclePolicy(
+                        TransitionToPrimaryStorageClass="AFTER_1_ACCESS"
+                    ),
+                ],
+            )
+        )
+
+        for index, private_subnet in enumerate(self.private_subnets):
+            self.template.add_resource(
+                efs.MountTarget(
+                    f"StocksFileSystemMountTarget{index + 1}",
+                    FileSystemId=Ref(self.file_system),
+                    SubnetId=Ref(private_subnet),
+                    SecurityGroups=[Ref(file_system_security_group)],
+                )
+            )
+
+        self.file_system_access_point = self.template.add_resource(
+            efs.AccessPoint(
+                "StocksFileSystemAccessPoint",
+                FileSystemId=Ref(self.file_system),
+                PosixUser=efs.PosixUser(Uid="1000", Gid="1000"),
+                RootDirectory=efs.RootDirectory(
+                    Path="/stocks-data",
+                    CreationInfo=efs.CreationInfo(
+                        OwnerUid="1000",
+                        OwnerGid="1000",
+                        Permissions="750",
+                    ),
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "FileSystemAccessPointArn",
+                Value=GetAtt(self.file_system_access_point, "Arn"),
+            )
+        )
+
+    def store_ssm_parameters(self):
+        self.template.add_resource(
+            ssm.Parameter(
+                "CacheSubnetIdsParameter",
+                Name=self.ssm_path("/cache/subnet/ids"),
+                Type="StringList",
+                Value=Join(",", [Ref(subnet) for subnet in self.private_subnets]),
+            )
+        )
+
+        self.template.add_resource(
+            ssm.Parameter(
+                "CacheLambdaSecurityGroupIdParameter",
+                Name=self.ssm_path("/cache/lambda/security/group/id"),
+                Type="String",
+                Value=Ref(self.lambda_security_group),
+            )
+        )
+
+        if "CacheName" in self.get_variables()["env-dict"]:
+            self.template.add_resource(
+                ssm.Parameter(
+                    "CacheEndpointParameter",
+                    Name=self.ssm_path("/cache/endpoint"),
+                    Type="String",
+                    Value=Join(
+                        ":",
+                        [
+                            GetAtt(self.serverless_cache, "Endpoint.Address"),
+                            GetAtt(self.serverless_cache, "Endpoint.Port"),
+                        ],
+                    ),
+                )
+            )
+
+        if self.get_variables()["env-dict"].get("FileSystemEnabled", False):
+            self.template.add_resource(
+                ssm.Parameter(
+                    "FileSystemArnParameter",
+                    Name=self.ssm_path("/cache/file/system/arn"),
+                    Type="String",
+                    Value=GetAtt(self.file_system, "Arn"),
+                )
+            )
+
+            self.template.add_resource(
+                ssm.Parameter(
+                    "FileSystemAccessPointArnParameter",
+                    Name=self.ssm_path("/cache/file/system/access/point/arn"),
+                    Type="String",
+                    Value=GetAtt(self.file_system_access_point, "Arn"),
+                )
+            )
+
+    def create_template(self):
+        self.create_vpc()
+        if self.get_variables()["env-dict"].get("NatGateway", True):
+            self.create_nat_gateways()
+        self.create_vpc_endpoints()
+        if "CacheName" in self.get_variables()["env-dict"]:
+            self.create_serverless_cache()
+        if self.get_variables()["env-dict"].get("FileSystemEnabled", False):
+            self.create_file_system()
+        self.store_ssm_parameters()
+        return self.template
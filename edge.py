@@ -0,0 +1,173 @@
+from stacker.blueprints.base import Blueprint
+from troposphere import (
+    Output,
+    Ref,
+    GetAtt,
+    Sub,
+    cloudfront,
+)
+
+# AWS managed CachingDisabled cache policy.
+CACHING_DISABLED_POLICY_ID = "4135ea2d-6df8-44a3-9df3-4b5a84be39ad"
+
+ALL_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "PATCH", "POST", "DELETE"]
+
+
+class Stocks(Blueprint):
+    VARIABLES = {"env-dict": {"type": dict}}
+
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
+    def resolve_ssm(self, path):
+        return "{{resolve:ssm:%s}}" % self.ssm_path(path)
+
+    def create_origin_request_policy(self):
+        # Uncached routes still need the API key and body headers at the origin.
+        # Host is left out so API Gateway sees its own domain.
+        self.origin_request_policy = self.template.add_resource(
+            cloudfront.OriginRequestPolicy(
+                "StocksApiOriginRequestPolicy",
+                OriginRequestPolicyConfig=cloudfront.OriginRequestPolicyConfig(
+                    Name=Sub("${AWS::StackName}-api-origin-request"),
+                    Comment="Forward the API key and query strings to the Stocks API",
+                    HeadersConfig=cloudfront.OriginRequestHeadersConfig(
+                        HeaderBehavior="whitelist",
+                        Headers=["x-api-key", "Content-Type", "Accept"],
+                    ),
+                    QueryStringsConfig=cloudfront.OriginRequestQueryStringsConfig(
+                        QueryStringBehavior="all",
+                    ),
+                    CookiesConfig=cloudfront.OriginRequestCookiesConfig(
+                        CookieBehavior="none",
+                    ),
+                ),
+            )
+        )
+
+    def create_read_cache_behaviors(self):
+        self.cache_behaviors = []
+        for cached_path in self.get_variables()["env-dict"].get("CachedPaths", []):
+            cached_path_id = "".join(
+                part.title() for part in cached_path["Name"].split("-")
+            )
+
+            if "QueryStrings" in cached_path:
+                query_strings_config = cloudfront.CacheQueryStringsConfig(
+                    QueryStringBehavior="whitelist",
+                    QueryStrings=cached_path["QueryStrings"],
+                )
+            else:
+                query_strings_config = cloudfront.CacheQueryStringsConfig(
+                    QueryStringBehavior="all",
+                )
+
+            # The API key is part of the cache key so a cached response is only
+            # ever served to callers presenting the same key.
+            cache_policy = self.template.add_resource(
+                cloudfront.CachePolicy(
+                    f"{cached_path_id}CachePolicy",
+                    CachePolicyConfig=cloudfront.CachePolicyConfig(
+                        Name=Sub(
+                            "${AWS::StackName}-${CachedPathId}",
+                            CachedPathId=cached_path_id,
+                        ),
+                        Comment=f"Read cache for {cached_path['PathPattern']}",
+                        DefaultTTL=cached_path.get("DefaultTTL", 30),
+                        MinTTL=cached_path.get("MinTTL", 0),
+                        MaxTTL=cached_path.get("MaxTTL", 300),
+                        ParametersInCacheKeyAndForwardedToOrigin=cloudfront.ParametersInCacheKeyAndForwardedToOrigin(
+                            EnableAcceptEncodingGzip=True,
+                            EnableAcceptEncodingBrotli=True,
+                            HeadersConfig=cloudfront.CacheHeadersConfig(
+                                HeaderBehavior="whitelist",
+                                Headers=["x-api-key"],
+                            ),
+                            QueryStringsConfig=query_strings_config,
+                            CookiesConfig=cloudfront.CacheCookiesConfig(
+                                CookieBehavior="none",
+                            ),
+                        ),
+                    ),
+                )
+            )
+
+            self.cache_behaviors.append(
+                cloudfront.CacheBehavior(
+                    PathPattern=cached_path["PathPattern"],
+                    TargetOriginId="StocksApiOrigin",
+                    ViewerProtocolPolicy="https-only",
+                    AllowedMethods=ALL_METHODS,
+                    CachedMethods=["GET", "HEAD"],
+                    CachePolicyId=Ref(cache_policy),
+                    Compress=True,
+                )
+            )
+
+        for path_pattern in ["/webhook*", "/sync*"]:
+            self.cache_behaviors.append(
+                cloudfront.CacheBehavior(
+                    PathPattern=path_pattern,
+                    TargetOriginId="StocksApiOrigin",
+                    ViewerProtocolPolicy="https-only",
+                    AllowedMethods=ALL_METHODS,
+                    CachedMethods=["GET", "HEAD"],
+                    CachePolicyId=CACHING_DISABLED_POLICY_ID,
+                    OriginRequestPolicyId=Ref(self.origin_request_policy),
+                    Compress=True,
+                )
+            )
+
+    def create_distribution(self):
+        distribution = self.template.add_resource(
+            cloudfront.Distribution(
+                "StocksApiDistribution",
+                DistributionConfig=cloudfront.DistributionConfig(
+                    Comment="Stocks API edge distribution",
+                    Enabled=True,
+                    HttpVersion="http2and3",
+                    IPV6Enabled=True,
+                    PriceClass=self.get_variables()["env-dict"].get(
+                        "PriceClass", "PriceClass_100"
+                    ),
+                    Origins=[
+                        cloudfront.Origin(
+                            Id="StocksApiOrigin",
+                            DomainName=Sub(
+                                "${ApiId}.execute-api.${AWS::Region}.amazonaws.com",
+                                ApiId=self.resolve_ssm("/api/id"),
+                            ),
+                            OriginPath="/api",
+                            CustomOriginConfig=cloudfront.CustomOriginConfig(
+                                OriginProtocolPolicy="https-only",
+                                OriginSSLProtocols=["TLSv1.2"],
+                                OriginKeepaliveTimeout=60,
+                            ),
+                        )
+                    ],
+                    CacheBehaviors=self.cache_behaviors,
+                    DefaultCacheBehavior=cloudfront.DefaultCacheBehavior(
+                        TargetOriginId="StocksApiOrigin",
+                        ViewerProtocolPolicy="https-only",
+                        AllowedMethods=ALL_METHODS,
+                        CachedMethods=["GET", "HEAD"],
+                        CachePolicyId=CACHING_DISABLED_POLICY_ID,
+                        OriginRequestPolicyId=Ref(self.origin_request_policy),
+                        Compress=True,
+                    ),
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "DistributionDomainName",
+                Value=GetAtt(distribution, "DomainName"),
+            )
+        )
+
+    def create_template(self):
+        self.create_origin_request_policy()
+        self.create_read_cache_behaviors()
+        self.create_distribution()
+        return self.template
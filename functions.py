@@ -0,0 +1,366 @@
+from stacker.blueprints.base import Blueprint
+from troposphere import (
+    Ref,
+    GetAtt,
+    iam,
+    awslambda,
+    Parameter,
+    Sub,
+)
+
+
+# Shared by the lambdas and jobs blueprints: SSM lookups, the optional cache
+# network, rate limiter, file system and data lake streams, and per-function
+# settings.
+class StocksFunctions(Blueprint):
+    VARIABLES = {"env-dict": {"type": dict}}
+
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
+    def resolve_ssm(self, path):
+        return "{{resolve:ssm:%s}}" % self.ssm_path(path)
+
+    def get_existing_stocks_bucket(self):
+        self.existing_stocks_bucket = self.template.add_parameter(
+            Parameter(
+                "StockS3Bucket",
+                Type="String",
+                Default=self.get_variables()["env-dict"]["BucketName"],
+            )
+        )
+
+    def uses_cache_network(self):
+        return self.get_variables()["env-dict"].get("CacheEnabled", False) or (
+            self.get_variables()["env-dict"].get("FileSystemEnabled", False)
+        )
+
+    def get_cache_network(self):
+        self.cache_subnet_ids = self.template.add_parameter(
+            Parameter(
+                "CacheSubnetIds",
+                Type="AWS::SSM::Parameter::Value<List<AWS::EC2::Subnet::Id>>",
+                Default=self.ssm_path("/cache/subnet/ids"),
+            )
+        )
+        self.cache_security_group_id = self.template.add_parameter(
+            Parameter(
+                "CacheLambdaSecurityGroupId",
+                Type="AWS::SSM::Parameter::Value<AWS::EC2::SecurityGroup::Id>",
+                Default=self.ssm_path("/cache/lambda/security/group/id"),
+            )
+        )
+
+        if self.get_variables()["env-dict"].get("FileSystemEnabled", False):
+            self.file_system_arn = self.template.add_parameter(
+                Parameter(
+                    "FileSystemArn",
+                    Type="AWS::SSM::Parameter::Value<String>",
+                    Default=self.ssm_path("/cache/file/system/arn"),
+                )
+            )
+            self.file_system_access_point_arn = self.template.add_parameter(
+                Parameter(
+                    "FileSystemAccessPointArn",
+                    Type="AWS::SSM::Parameter::Value<String>",
+                    Default=self.ssm_path("/cache/file/system/access/point/arn"),
+                )
+            )
+
+    def get_rate_limiter(self):
+        self.rate_limiter_table_arn = self.template.add_parameter(
+            Parameter(
+                "RateLimiterTableArn",
+                Type="AWS::SSM::Parameter::Value<String>",
+                Default=self.ssm_path("/rate/limiter/table/arn"),
+            )
+        )
+
+    def get_data_lake_streams(self):
+        self.data_lake_stream_arns = {}
+        for tables in self.get_variables()["env-dict"]["DataLakeTables"].values():
+            for table in tables:
+                if table in self.data_lake_stream_arns:
+                    continue
+                self.data_lake_stream_arns[table] = self.template.add_parameter(
+                    Parameter(
+                        "".join(part.title() for part in table.split("_"))
+                        + "DeliveryStreamArn",
+                        Type="AWS::SSM::Parameter::Value<String>",
+                        Default=self.ssm_path(f"/data/lake/{table}/delivery/stream/arn"),
+                    )
+                )
+
+    def attach_shared_resources(self, lambda_role, lambda_function):
+        if self.uses_cache_network():
+            lambda_role.ManagedPolicyArns = [
+                Sub(
+                    "arn:${AWS::Partition}:iam::aws:policy/service-role/AWSLambdaVPCAccessExecutionRole"
+                )
+            ]
+            lambda_function.VpcConfig = awslambda.VPCConfig(
+                SubnetIds=Ref(self.cache_subnet_ids),
+                SecurityGroupIds=[Ref(self.cache_security_group_id)],
+            )
+
+        if self.get_variables()["env-dict"].get("CacheEnabled", False):
+            lambda_function.Environment.Variables[
+                "CACHE_ENDPOINT"
+            ] = self.resolve_ssm("/cache/endpoint")
+
+        if self.get_variables()["env-dict"].get("FileSystemEnabled", False):
+            lambda_role.Policies.append(
+                iam.Policy(
+                    PolicyName=f"{lambda_function.title}FileSystemPolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "elasticfilesystem:ClientMount",
+                                    "elasticfilesystem:ClientWrite",
+                                ],
+                                "Resource": [Ref(self.file_system_arn)],
+                                "Condition": {
+                                    "StringEquals": {
+                                        "elasticfilesystem:AccessPointArn": Ref(
+                                            self.file_system_access_point_arn
+                                        )
+                                    }
+                                },
+                            }
+                        ],
+                    },
+                )
+            )
+            lambda_function.FileSystemConfigs = [
+                awslambda.FileSystemConfig(
+                    Arn=Ref(self.file_system_access_point_arn),
+                    LocalMountPath="/mnt/stocks-data",
+                )
+            ]
+            lambda_function.Environment.Variables["DATA_CACHE_PATH"] = "/mnt/stocks-data"
+
+        if self.get_variables()["env-dict"].get("RateLimiterEnabled", False):
+            lambda_role.Policies.append(
+                iam.Policy(
+                    PolicyName=f"{lambda_function.title}RateLimiterPolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "dynamodb:GetItem",
+                                    "dynamodb:PutItem",
+                                    "dynamodb:UpdateItem",
+                                ],
+                                "Resource": [Ref(self.rate_limiter_table_arn)],
+                            }
+                        ],
+                    },
+                )
+            )
+            lambda_function.Environment.Variables[
+                "RATE_LIMITER_TABLE"
+            ] = self.resolve_ssm("/rate/limiter/table/name")
+            lambda_function.Environment.Variables[
+                "RATE_LIMITER_BUCKETS"
+            ] = self.resolve_ssm("/rate/limiter/buckets")
+
+        data_lake_tables = (
+            self.get_variables()["env-dict"]
+            .get("DataLakeTables", {})
+            .get(lambda_function.FunctionName, [])
+        )
+        if data_lake_tables:
+            lambda_role.Policies.append(
+                iam.Policy(
+                    PolicyName=f"{lambda_function.title}DataLakePolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "firehose:PutRecord",
+                                    "firehose:PutRecordBatch",
+                                ],
+                                "Resource": [
+                                    Ref(self.data_lake_stream_arns[table])
+                                    for table in data_lake_tables
+                                ],
+                            }
+                        ],
+                    },
+                )
+            )
+            for table in data_lake_tables:
+                lambda_function.Environment.Variables[
+                    f"{table.upper()}_DELIVERY_STREAM_NAME"
+                ] = self.resolve_ssm(f"/data/lake/{table}/delivery/stream/name")
+
+    def apply_function_settings(self, lambda_role, lambda_function):
+        function_name = lambda_function.FunctionName
+        function_settings = self.get_variables()["env-dict"].get(
+            "FunctionSettings", {}
+        ).get(function_name, {})
+
+        if "MemorySize" in function_settings:
+            lambda_function.MemorySize = function_settings["MemorySize"]
+
+        # provided.al2023 functions ship a native binary, so arm64 needs its own
+        # build artifact next to the x86_64 one.
+        if function_settings.get("Architecture", "x86_64") == "arm64":
+            lambda_function.Architectures = ["arm64"]
+            lambda_function.Code = awslambda.Code(
+                S3Bucket=Ref(self.existing_stocks_bucket),
+                S3Key=Sub("lambdas/${LambdaName}-arm64.zip", LambdaName=function_name),
+            )
+
+        # Pins the deploy to one version of the artifact on a versioned bucket,
+        # so a rollback is a config change rather than a re-upload.
+        if "S3ObjectVersion" in function_settings:
+            lambda_function.Code.S3ObjectVersion = function_settings["S3ObjectVersion"]
+
+        if not self.get_variables()["env-dict"].get("PowerTuningTwins", False):
+            return
+
+        # Tuning invokes the twins hundreds of times, so they must never reach
+        # the live broker account or the live resources behind it: they run
+        # with DRY_RUN set against the PowerTuningSecretsId sandbox account,
+        # under their own role, outside the cache network, and without the
+        # variables that publish signals, arm cancel timers, draw from the
+        # shared broker rate limiter, write the data lake or read the cache and
+        # hot data.
+        env_dict = self.get_variables()["env-dict"]
+        if "PowerTuningSecretsId" not in env_dict:
+            raise ValueError("PowerTuningTwins requires PowerTuningSecretsId")
+
+        twin_role = self.template.add_resource(
+            iam.Role(
+                f"{lambda_function.title}TuningTwinRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": ["lambda.amazonaws.com"]},
+                            "Action": ["sts:AssumeRole"],
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName=f"{lambda_function.title}TuningTwinS3Policy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["s3:GetObject"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:s3:::${BucketName}/*",
+                                            BucketName=env_dict["BucketName"],
+                                        )
+                                    ],
+                                }
+                            ],
+                        },
+                    ),
+                    iam.Policy(
+                        PolicyName=f"{lambda_function.title}TuningTwinLogPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": "logs:CreateLogGroup",
+                                    "Resource": Sub(
+                                        "arn:aws:logs:${AWS::Region}:${AWS::AccountId}:*"
+                                    ),
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "logs:CreateLogStream",
+                                        "logs:PutLogEvents",
+                                    ],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:logs:${AWS::Region}:${AWS::AccountId}:log-group:/aws/lambda/${LambdaName}-tuning-*:*",
+                                            LambdaName=function_name,
+                                        )
+                                    ],
+                                },
+                            ],
+                        },
+                    ),
+                    iam.Policy(
+                        PolicyName=f"{lambda_function.title}TuningTwinSecretsManagerPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["secretsmanager:GetSecretValue"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
+                                            SecretId=env_dict["PowerTuningSecretsId"],
+                                        )
+                                    ],
+                                }
+                            ],
+                        },
+                    ),
+                ],
+            )
+        )
+
+        twin_environment = {
+            variable: value
+            for variable, value in lambda_function.Environment.Variables.items()
+            if variable
+            not in [
+                "SIGNAL_STREAM_NAME",
+                "SIGNAL_BUS_NAME",
+                "CACHE_ENDPOINT",
+                "DATA_CACHE_PATH",
+                "HOT_DATA_BUCKET",
+            ]
+            and not variable.startswith(("ORDER_CANCEL_TIMER_", "RATE_LIMITER_"))
+            and not variable.endswith("_DELIVERY_STREAM_NAME")
+        }
+        twin_environment["DRY_RUN"] = "true"
+        twin_environment["SHARED_SECRETS"] = env_dict["PowerTuningSecretsId"]
+        twin_properties = {
+            prop: value
+            for prop, value in lambda_function.properties.items()
+            if prop not in ["VpcConfig", "FileSystemConfigs"]
+        }
+
+        for architecture, artifact in [("x86_64", ""), ("arm64", "-arm64")]:
+            self.template.add_resource(
+                awslambda.Function(
+                    f"{lambda_function.title}{architecture.title().replace('_', '')}TuningTwin",
+                    **dict(
+                        twin_properties,
+                        FunctionName=f"{function_name}-tuning-{architecture}",
+                        Role=GetAtt(twin_role, "Arn"),
+                        Environment=awslambda.Environment(
+                            Variables=dict(twin_environment)
+                        ),
+                        Architectures=[architecture],
+                        Code=awslambda.Code(
+                            S3Bucket=Ref(self.existing_stocks_bucket),
+                            S3Key=Sub(
+                                f"lambdas/${{LambdaName}}{artifact}.zip",
+                                LambdaName=function_name,
+                            ),
+                        ),
+                    ),
+                )
+            )
@@ -8,11 +8,17 @@ from troposphere import (
 class Stocks(Blueprint):
     VARIABLES = {"env-dict": {"type": dict}}
 
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
+    def resolve_ssm(self, path):
+        return "{{resolve:ssm:%s}}" % self.ssm_path(path)
+
     def create_template(self):
         stocks_api_deployment = self.template.add_resource(
             apigateway.Deployment(
                 "StocksApiDeployment",
-                RestApiId="{{resolve:ssm:/stocks/api/id}}",
+                RestApiId=self.resolve_ssm("/api/id"),
             )
         )
 
@@ -20,7 +26,7 @@ class Stocks(Blueprint):
             apigateway.Stage(
                 "StocksApiStage",
                 DeploymentId=Ref(stocks_api_deployment),
-                RestApiId="{{resolve:ssm:/stocks/api/id}}",
+                RestApiId=self.resolve_ssm("/api/id"),
                 StageName="api",
             )
         )
@@ -32,7 +38,7 @@ class Stocks(Blueprint):
                 UsagePlanName=self.get_variables()["env-dict"]["ApiUsagePlanName"],
                 ApiStages=[
                     apigateway.ApiStage(
-                        ApiId="{{resolve:ssm:/stocks/api/id}}",
+                        ApiId=self.resolve_ssm("/api/id"),
                         Stage="api",
                     )
                 ],
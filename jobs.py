@@ -1,5 +1,8 @@
-from stacker.blueprints.base import Blueprint
+import datetime
+import zoneinfo
+
 from troposphere import (
+    Output,
     Ref,
     GetAtt,
     iam,
@@ -7,19 +10,212 @@ from troposphere import (
     Parameter,
     Sub,
     apigateway,
-    scheduler
+    scheduler,
+    sqs,
+    ssm,
 )
 
+from functions import StocksFunctions
 
-class Stocks(Blueprint):
-    VARIABLES = {"env-dict": {"type": dict}}
 
-    def get_existing_stocks_bucket(self):
-        self.existing_stocks_bucket = self.template.add_parameter(
-            Parameter(
-                "StockS3Bucket",
-                Type="String",
-                Default=self.get_variables()["env-dict"]["BucketName"],
+class Stocks(StocksFunctions):
+    def get_market_calendar(self):
+        market_calendar = {
+            "Timezone": "America/Los_Angeles",
+            "TradingDays": "MON-FRI",
+            "ScheduleGroupName": "stocks-market-schedules",
+            "Holidays": [],
+        }
+        market_calendar.update(self.get_variables()["env-dict"].get("MarketCalendar", {}))
+        return market_calendar
+
+    def create_market_schedule_group(self):
+        self.market_schedule_group = self.template.add_resource(
+            scheduler.ScheduleGroup(
+                "MarketScheduleGroup",
+                Name=self.get_market_calendar()["ScheduleGroupName"],
+            )
+        )
+
+    def get_market_schedule_windows(self):
+        # Scheduler has no exclusion dates, so every job schedule is split into
+        # windows that close at local midnight on each exchange holiday and
+        # reopen at local midnight the next day, in the calendar's timezone.
+        market_timezone = zoneinfo.ZoneInfo(self.get_market_calendar()["Timezone"])
+        now = datetime.datetime.now(market_timezone)
+        windows = []
+        start_date = None
+        for holiday in sorted(
+            datetime.date.fromisoformat(str(holiday))
+            for holiday in self.get_market_calendar()["Holidays"]
+        ):
+            end_date = datetime.datetime.combine(
+                holiday, datetime.time(0), tzinfo=market_timezone
+            )
+            if end_date > now:
+                windows.append((start_date, end_date))
+            start_date = datetime.datetime.combine(
+                holiday + datetime.timedelta(days=1),
+                datetime.time(0),
+                tzinfo=market_timezone,
+            )
+        windows.append((start_date, None))
+
+        return [
+            (start_date if start_date and start_date > now else None, end_date)
+            for start_date, end_date in windows
+        ]
+
+    def add_market_schedules(
+        self, title, name, description, minutes, hours, target, flexible_window=0
+    ):
+        market_calendar = self.get_market_calendar()
+        if flexible_window:
+            flexible_time_window = scheduler.FlexibleTimeWindow(
+                Mode="FLEXIBLE", MaximumWindowInMinutes=flexible_window
+            )
+        else:
+            flexible_time_window = scheduler.FlexibleTimeWindow(Mode="OFF")
+
+        for start_date, end_date in self.get_market_schedule_windows():
+            market_schedule = scheduler.Schedule(
+                title if end_date is None else f"{title}{end_date:%Y%m%d}",
+                Name=name if end_date is None else f"{name}-{end_date:%Y%m%d}",
+                GroupName=Ref(self.market_schedule_group),
+                Description=description,
+                ScheduleExpression=f"cron({minutes} {hours} ? * {market_calendar['TradingDays']} *)",
+                ScheduleExpressionTimezone=market_calendar["Timezone"],
+                FlexibleTimeWindow=flexible_time_window,
+                Target=target,
+            )
+            if start_date is not None:
+                market_schedule.StartDate = (
+                    f"{start_date.astimezone(datetime.timezone.utc):%Y-%m-%dT%H:%M:%SZ}"
+                )
+            if end_date is not None:
+                market_schedule.EndDate = (
+                    f"{end_date.astimezone(datetime.timezone.utc):%Y-%m-%dT%H:%M:%SZ}"
+                )
+            self.template.add_resource(market_schedule)
+
+    def get_market_session_crons(self, open_time, close_time, rate):
+        # Expand an HH:MM session into (minutes, hours) cron fields: the partial
+        # opening hour, the full hours in between and the closing minute(s).
+        open_hour, open_minute = (int(part) for part in open_time.split(":"))
+        close_hour, close_minute = (int(part) for part in close_time.split(":"))
+        if open_hour == close_hour:
+            return [(f"{open_minute}-{close_minute}/{rate}", f"{open_hour}")]
+
+        crons = []
+        if open_minute:
+            crons.append((f"{open_minute}-59/{rate}", f"{open_hour}"))
+            open_hour += 1
+        if open_hour < close_hour:
+            crons.append((f"0/{rate}", f"{open_hour}-{close_hour - 1}"))
+        if close_minute:
+            crons.append((f"0-{close_minute}/{rate}", f"{close_hour}"))
+        else:
+            crons.append(("0", f"{close_hour}"))
+        return crons
+
+    def get_schedule_retry_policy(self, title, default_attempts=3, default_age=3600):
+        retry_policy = self.get_variables()["env-dict"].get(
+            "ScheduleRetryPolicies", {}
+        ).get(title, {})
+        return scheduler.RetryPolicy(
+            MaximumEventAgeInSeconds=retry_policy.get(
+                "MaximumEventAgeInSeconds", default_age
+            ),
+            MaximumRetryAttempts=retry_policy.get(
+                "MaximumRetryAttempts", default_attempts
+            ),
+        )
+
+    def create_schedule_dead_letter_queue(self, title, scheduler_execution_role):
+        dead_letter_queue = self.template.add_resource(
+            sqs.Queue(
+                f"{title}DeadLetterQueue",
+                MessageRetentionPeriod=1209600,
+                SqsManagedSseEnabled=True,
+            )
+        )
+
+        scheduler_execution_role.Policies.append(
+            iam.Policy(
+                PolicyName=f"{title}DeadLetterQueuePolicy",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": ["sqs:SendMessage"],
+                            "Resource": [GetAtt(dead_letter_queue, "Arn")],
+                        },
+                    ],
+                },
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                f"{title}DeadLetterQueueUrl",
+                Value=Ref(dead_letter_queue),
+            )
+        )
+        return scheduler.DeadLetterConfig(Arn=GetAtt(dead_letter_queue, "Arn"))
+
+    def create_failure_destination(self, lambda_role, lambda_function):
+        # The scheduler hands events to Lambda asynchronously, so function
+        # errors are retried by Lambda itself. Bound those retries too and park
+        # whatever is left for a deliberate replay.
+        failure_queue = self.template.add_resource(
+            sqs.Queue(
+                f"{lambda_function.title}FailureQueue",
+                MessageRetentionPeriod=1209600,
+                SqsManagedSseEnabled=True,
+            )
+        )
+
+        lambda_role.Policies.append(
+            iam.Policy(
+                PolicyName=f"{lambda_function.title}FailureQueuePolicy",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": ["sqs:SendMessage"],
+                            "Resource": [GetAtt(failure_queue, "Arn")],
+                        },
+                    ],
+                },
+            )
+        )
+
+        retry_policy = self.get_variables()["env-dict"].get(
+            "FunctionRetryPolicies", {}
+        ).get(lambda_function.title, {})
+        self.template.add_resource(
+            awslambda.EventInvokeConfig(
+                f"{lambda_function.title}EventInvokeConfig",
+                FunctionName=Ref(lambda_function),
+                Qualifier="$LATEST",
+                MaximumRetryAttempts=retry_policy.get("MaximumRetryAttempts", 1),
+                MaximumEventAgeInSeconds=retry_policy.get(
+                    "MaximumEventAgeInSeconds", 3600
+                ),
+                DestinationConfig=awslambda.DestinationConfig(
+                    OnFailure=awslambda.OnFailure(
+                        Destination=GetAtt(failure_queue, "Arn")
+                    )
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                f"{lambda_function.title}FailureQueueUrl",
+                Value=Ref(failure_queue),
             )
         )
 
@@ -103,7 +299,7 @@ class Stocks(Blueprint):
                                     "Action": ["secretsmanager:GetSecretValue"],
                                     "Resource": [
                                         Sub(
-                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-5BII06",
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
                                             SecretId=self.get_variables()["env-dict"][
                                                 "SharedSecretsId"
                                             ],
@@ -141,12 +337,16 @@ class Stocks(Blueprint):
             Runtime="provided.al2023",
             Role=GetAtt(lambda_role, "Arn"),
         )
+        self.order_sync_lambda_role = lambda_role
+        self.attach_shared_resources(lambda_role, self.stocks_order_sync_lambda_function)
+        self.apply_function_settings(lambda_role, self.stocks_order_sync_lambda_function)
         self.template.add_resource(self.stocks_order_sync_lambda_function)
+        self.create_failure_destination(lambda_role, self.stocks_order_sync_lambda_function)
 
         self.order_sync_api_resource = apigateway.Resource(
             "OrderSyncResource",
-            ParentId="{{resolve:ssm:/stocks/sync/resource/id}}",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            ParentId=self.resolve_ssm("/sync/resource/id"),
+            RestApiId=self.resolve_ssm("/api/id"),
             PathPart="orders",
         )
         self.template.add_resource(self.order_sync_api_resource)
@@ -157,7 +357,7 @@ class Stocks(Blueprint):
             AuthorizationType="NONE",
             ApiKeyRequired=True,
             HttpMethod="POST",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            RestApiId=self.resolve_ssm("/api/id"),
             ResourceId=Ref(self.order_sync_api_resource),
             Integration=apigateway.Integration(
                 IntegrationHttpMethod="POST",
@@ -181,7 +381,7 @@ class Stocks(Blueprint):
                 Principal="apigateway.amazonaws.com",
                 SourceArn=Sub(
                     "arn:aws:execute-api:${AWS::Region}:${AWS::AccountId}:${ApiId}/*/POST/sync/orders",
-                    ApiId="{{resolve:ssm:/stocks/api/id}}",
+                    ApiId=self.resolve_ssm("/api/id"),
                 ),
             )
         )
@@ -220,26 +420,55 @@ class Stocks(Blueprint):
             )
         )
 
-        order_sync_scheduler = scheduler.Schedule(
+        dead_letter_config = self.create_schedule_dead_letter_queue(
+            "OrderSyncScheduler", scheduler_execution_role
+        )
+        self.add_market_schedules(
             "OrderSyncScheduler",
-            Name="order-sync-scheduler",
-            Description="Order Sync Scheduler",
-            ScheduleExpression="cron(0 18 ? * MON-FRI *)",
-            ScheduleExpressionTimezone="America/Los_Angeles",
-            FlexibleTimeWindow=scheduler.FlexibleTimeWindow(
-                Mode="OFF"
-            ),
-            Target=scheduler.Target(
+            "order-sync-scheduler",
+            "Order Sync Scheduler",
+            "0",
+            "18",
+            scheduler.Target(
                 Arn=GetAtt(self.stocks_order_sync_lambda_function, "Arn"),
                 Input='{"httpMethod": "POST", "path": "/sync/orders"}',
-                RetryPolicy=scheduler.RetryPolicy(
-                    MaximumEventAgeInSeconds=86400,
-                    MaximumRetryAttempts=185
-                ),
+                RetryPolicy=self.get_schedule_retry_policy("OrderSyncScheduler"),
+                DeadLetterConfig=dead_letter_config,
                 RoleArn=GetAtt(scheduler_execution_role, "Arn")
-            )
+            ),
         )
-        self.template.add_resource(order_sync_scheduler)
+
+        intraday_sync = self.get_market_calendar().get("IntradaySync")
+        if intraday_sync:
+            intraday_dead_letter_config = self.create_schedule_dead_letter_queue(
+                "IntradayOrderSyncScheduler", scheduler_execution_role
+            )
+            for index, (minutes, hours) in enumerate(
+                self.get_market_session_crons(
+                    intraday_sync.get("Open", "06:30"),
+                    intraday_sync.get("Close", "13:00"),
+                    intraday_sync.get("RateMinutes", 1),
+                )
+            ):
+                self.add_market_schedules(
+                    f"IntradayOrderSyncScheduler{index + 1}",
+                    f"intraday-order-sync-scheduler-{index + 1}",
+                    "Intraday incremental Order Sync Scheduler",
+                    minutes,
+                    hours,
+                    scheduler.Target(
+                        Arn=GetAtt(self.stocks_order_sync_lambda_function, "Arn"),
+                        Input='{"httpMethod": "POST", "path": "/sync/orders", "queryStringParameters": {"mode": "incremental"}}',
+                        RetryPolicy=self.get_schedule_retry_policy(
+                            "IntradayOrderSyncScheduler",
+                            default_attempts=0,
+                            default_age=60,
+                        ),
+                        DeadLetterConfig=intraday_dead_letter_config,
+                        RoleArn=GetAtt(scheduler_execution_role, "Arn")
+                    ),
+                    flexible_window=intraday_sync.get("FlexibleWindowMinutes", 1),
+                )
 
     def create_stock_profit_calculator_lambda(self):
         lambda_role = self.template.add_resource(
@@ -321,7 +550,7 @@ class Stocks(Blueprint):
                                     "Action": ["secretsmanager:GetSecretValue"],
                                     "Resource": [
                                         Sub(
-                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-5BII06",
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
                                             SecretId=self.get_variables()["env-dict"][
                                                 "SharedSecretsId"
                                             ],
@@ -359,12 +588,15 @@ class Stocks(Blueprint):
             Runtime="provided.al2023",
             Role=GetAtt(lambda_role, "Arn"),
         )
+        self.attach_shared_resources(lambda_role, self.stocks_profit_calculator_lambda_function)
+        self.apply_function_settings(lambda_role, self.stocks_profit_calculator_lambda_function)
         self.template.add_resource(self.stocks_profit_calculator_lambda_function)
+        self.create_failure_destination(lambda_role, self.stocks_profit_calculator_lambda_function)
 
         self.profit_calculator_api_resource = apigateway.Resource(
             "ProfitCalculatorResource",
-            ParentId="{{resolve:ssm:/stocks/sync/resource/id}}",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            ParentId=self.resolve_ssm("/sync/resource/id"),
+            RestApiId=self.resolve_ssm("/api/id"),
             PathPart="profit",
         )
         self.template.add_resource(self.profit_calculator_api_resource)
@@ -375,7 +607,7 @@ class Stocks(Blueprint):
             AuthorizationType="NONE",
             ApiKeyRequired=True,
             HttpMethod="POST",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            RestApiId=self.resolve_ssm("/api/id"),
             ResourceId=Ref(self.profit_calculator_api_resource),
             Integration=apigateway.Integration(
                 IntegrationHttpMethod="POST",
@@ -399,7 +631,7 @@ class Stocks(Blueprint):
                 Principal="apigateway.amazonaws.com",
                 SourceArn=Sub(
                     "arn:aws:execute-api:${AWS::Region}:${AWS::AccountId}:${ApiId}/*/POST/sync/profit",
-                    ApiId="{{resolve:ssm:/stocks/api/id}}",
+                    ApiId=self.resolve_ssm("/api/id"),
                 ),
             )
         )
@@ -438,26 +670,23 @@ class Stocks(Blueprint):
             )
         )
 
-        profit_calculator_scheduler = scheduler.Schedule(
+        dead_letter_config = self.create_schedule_dead_letter_queue(
+            "ProfitCalculatorScheduler", scheduler_execution_role
+        )
+        self.add_market_schedules(
             "ProfitCalculatorScheduler",
-            Name="profit-calculator-scheduler",
-            Description="Profit Calculator Scheduler",
-            ScheduleExpression="cron(0 19 ? * MON-FRI *)",
-            ScheduleExpressionTimezone="America/Los_Angeles",
-            FlexibleTimeWindow=scheduler.FlexibleTimeWindow(
-                Mode="OFF"
-            ),
-            Target=scheduler.Target(
+            "profit-calculator-scheduler",
+            "Profit Calculator Scheduler",
+            "0",
+            "19",
+            scheduler.Target(
                 Arn=GetAtt(self.stocks_profit_calculator_lambda_function, "Arn"),
                 Input='{"httpMethod": "POST", "path": "/sync/profit"}',
-                RetryPolicy=scheduler.RetryPolicy(
-                    MaximumEventAgeInSeconds=86400,
-                    MaximumRetryAttempts=185
-                ),
+                RetryPolicy=self.get_schedule_retry_policy("ProfitCalculatorScheduler"),
+                DeadLetterConfig=dead_letter_config,
                 RoleArn=GetAtt(scheduler_execution_role, "Arn")
-            )
+            ),
         )
-        self.template.add_resource(profit_calculator_scheduler)
 
 
 
@@ -541,7 +770,7 @@ class Stocks(Blueprint):
                                     "Action": ["secretsmanager:GetSecretValue"],
                                     "Resource": [
                                         Sub(
-                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-5BII06",
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
                                             SecretId=self.get_variables()["env-dict"][
                                                 "SharedSecretsId"
                                             ],
@@ -579,12 +808,15 @@ class Stocks(Blueprint):
             Runtime="provided.al2023",
             Role=GetAtt(lambda_role, "Arn"),
         )
+        self.attach_shared_resources(lambda_role, self.stocks_cancel_lambda_function)
+        self.apply_function_settings(lambda_role, self.stocks_cancel_lambda_function)
         self.template.add_resource(self.stocks_cancel_lambda_function)
+        self.create_failure_destination(lambda_role, self.stocks_cancel_lambda_function)
 
         self.cancel_orders_api_resource = apigateway.Resource(
             "CancelOrdersResource",
-            ParentId="{{resolve:ssm:/stocks/sync/resource/id}}",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            ParentId=self.resolve_ssm("/sync/resource/id"),
+            RestApiId=self.resolve_ssm("/api/id"),
             PathPart="cancel",
         )
         self.template.add_resource(self.cancel_orders_api_resource)
@@ -595,7 +827,7 @@ class Stocks(Blueprint):
             AuthorizationType="NONE",
             ApiKeyRequired=True,
             HttpMethod="POST",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            RestApiId=self.resolve_ssm("/api/id"),
             ResourceId=Ref(self.cancel_orders_api_resource),
             Integration=apigateway.Integration(
                 IntegrationHttpMethod="POST",
@@ -619,7 +851,7 @@ class Stocks(Blueprint):
                 Principal="apigateway.amazonaws.com",
                 SourceArn=Sub(
                     "arn:aws:execute-api:${AWS::Region}:${AWS::AccountId}:${ApiId}/*/POST/sync/cancel",
-                    ApiId="{{resolve:ssm:/stocks/api/id}}",
+                    ApiId=self.resolve_ssm("/api/id"),
                 ),
             )
         )
@@ -658,33 +890,426 @@ class Stocks(Blueprint):
             )
         )
 
-        cancel_orders_scheduler = scheduler.Schedule(
+        dead_letter_config = self.create_schedule_dead_letter_queue(
+            "CancelOrdersScheduler", scheduler_execution_role
+        )
+        self.add_market_schedules(
             "CancelOrdersScheduler",
-            Name="cancel-orders-scheduler",
-            Description="Cancel orders Scheduler",
-            ScheduleExpression="cron(40 17 ? * MON-FRI *)",
-            ScheduleExpressionTimezone="America/Los_Angeles",
-            FlexibleTimeWindow=scheduler.FlexibleTimeWindow(
-                Mode="OFF"
-            ),
-            Target=scheduler.Target(
+            "cancel-orders-scheduler",
+            "Cancel orders Scheduler",
+            "40",
+            "17",
+            scheduler.Target(
                 Arn=GetAtt(self.stocks_cancel_lambda_function, "Arn"),
                 Input='{"httpMethod": "POST", "path": "/sync/cancel"}',
-                RetryPolicy=scheduler.RetryPolicy(
-                    MaximumEventAgeInSeconds=86400,
-                    MaximumRetryAttempts=185
-                ),
+                RetryPolicy=self.get_schedule_retry_policy("CancelOrdersScheduler"),
+                DeadLetterConfig=dead_letter_config,
                 RoleArn=GetAtt(scheduler_execution_role, "Arn")
+            ),
+        )
+
+    def create_stocks_export_lambda(self):
+        env_dict = self.get_variables()["env-dict"]
+        lambda_role = self.template.add_resource(
+            iam.Role(
+                "ExportLambdaExecutionRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": ["lambda.amazonaws.com"]},
+                            "Action": ["sts:AssumeRole"],
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName="ExportLambdaS3Policy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["s3:GetObject"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:s3:::${BucketName}/*",
+                                            BucketName=env_dict["BucketName"],
+                                        )
+                                    ],
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["s3:ListBucket"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:s3:::${BucketName}",
+                                            BucketName=env_dict["BucketName"],
+                                        )
+                                    ],
+                                },
+                            ],
+                        },
+                    ),
+                    iam.Policy(
+                        PolicyName="ExportLambdaLogPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": "logs:CreateLogGroup",
+                                    "Resource": Sub(
+                                        "arn:aws:logs:${AWS::Region}:${AWS::AccountId}:*"
+                                    ),
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "logs:CreateLogStream",
+                                        "logs:PutLogEvents",
+                                    ],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:logs:${AWS::Region}:${AWS::AccountId}:log-group:/aws/lambda/${LambdaName}:*",
+                                            LambdaName=env_dict[
+                                                "ExportLambdaName"
+                                            ],
+                                        )
+                                    ],
+                                },
+                            ],
+                        },
+                    ),
+                    iam.Policy(
+                        PolicyName="ExportLambdaSecretsManagerPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["secretsmanager:GetSecretValue"],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
+                                            SecretId=env_dict["SharedSecretsId"],
+                                        )
+                                    ],
+                                }
+                            ],
+                        },
+                    ),
+                ],
+            )
+        )
+
+        # Rows are written to the stream as they are read, so an export is
+        # bounded by the function timeout rather than a buffered payload size.
+        self.stocks_export_lambda_function = awslambda.Function(
+            "ExportLambdaFunction",
+            FunctionName=env_dict["ExportLambdaName"],
+            Code=awslambda.Code(
+                S3Bucket=Ref(self.existing_stocks_bucket),
+                S3Key=Sub(
+                    "lambdas/${LambdaName}.zip",
+                    LambdaName=env_dict["ExportLambdaName"],
+                ),
+            ),
+            Environment=awslambda.Environment(
+                Variables={
+                    "SHARED_SECRETS": env_dict["SharedSecretsId"],
+                    "EXPORT_FORMATS": "ndjson,csv",
+                }
+            ),
+            Timeout=env_dict.get("ExportTimeout", 900),
+            MemorySize=512,
+            Handler="handler",
+            Runtime="provided.al2023",
+            Role=GetAtt(lambda_role, "Arn"),
+        )
+        self.attach_shared_resources(lambda_role, self.stocks_export_lambda_function)
+        self.apply_function_settings(lambda_role, self.stocks_export_lambda_function)
+        self.template.add_resource(self.stocks_export_lambda_function)
+
+        export_auth_type = env_dict.get("ExportAuthType", "AWS_IAM")
+        export_function_url = self.template.add_resource(
+            awslambda.Url(
+                "ExportFunctionUrl",
+                DependsOn=self.stocks_export_lambda_function,
+                TargetFunctionArn=GetAtt(self.stocks_export_lambda_function, "Arn"),
+                AuthType=export_auth_type,
+                InvokeMode="RESPONSE_STREAM",
+                Cors=awslambda.Cors(
+                    AllowOrigins=env_dict.get("ExportAllowOrigins", []),
+                    AllowMethods=["GET"],
+                    AllowHeaders=[
+                        "authorization",
+                        "content-type",
+                        "x-amz-date",
+                        "x-amz-security-token",
+                        "x-amz-content-sha256",
+                    ],
+                    ExposeHeaders=["content-disposition"],
+                    MaxAge=3600,
+                ),
+            )
+        )
+
+        if export_auth_type == "AWS_IAM":
+            # Callers sign requests with SigV4; roles listed in
+            # ExportInvokerRoleNames may call the URL and nothing else.
+            self.template.add_resource(
+                iam.ManagedPolicy(
+                    "ExportFunctionUrlInvokePolicy",
+                    Roles=env_dict.get("ExportInvokerRoleNames", []),
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": ["lambda:InvokeFunctionUrl"],
+                                "Resource": [
+                                    GetAtt(self.stocks_export_lambda_function, "Arn")
+                                ],
+                                "Condition": {
+                                    "StringEquals": {
+                                        "lambda:FunctionUrlAuthType": "AWS_IAM"
+                                    }
+                                },
+                            },
+                            {
+                                "Effect": "Allow",
+                                "Action": ["lambda:InvokeFunction"],
+                                "Resource": [
+                                    GetAtt(self.stocks_export_lambda_function, "Arn")
+                                ],
+                                "Condition": {
+                                    "Bool": {"lambda:InvokedViaFunctionUrl": "true"}
+                                },
+                            },
+                        ],
+                    },
+                )
+            )
+        else:
+            self.template.add_resource(
+                awslambda.Permission(
+                    "ExportFunctionUrlPublicPermission",
+                    DependsOn=self.stocks_export_lambda_function,
+                    Action="lambda:InvokeFunctionUrl",
+                    FunctionName=env_dict["ExportLambdaName"],
+                    Principal="*",
+                    FunctionUrlAuthType="NONE",
+                )
+            )
+            self.template.add_resource(
+                awslambda.Permission(
+                    "ExportFunctionUrlInvokePermission",
+                    DependsOn=self.stocks_export_lambda_function,
+                    Action="lambda:InvokeFunction",
+                    FunctionName=env_dict["ExportLambdaName"],
+                    Principal="*",
+                    InvokedViaFunctionUrl=True,
+                )
+            )
+
+        self.template.add_resource(
+            ssm.Parameter(
+                "ExportFunctionUrlParameter",
+                Name=self.ssm_path("/export/function/url"),
+                Type="String",
+                Value=GetAtt(export_function_url, "FunctionUrl"),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "ExportFunctionUrl",
+                Value=GetAtt(export_function_url, "FunctionUrl"),
+            )
+        )
+
+    def create_order_cancel_timers(self):
+        order_cancel_timers = self.get_variables()["env-dict"]["OrderCancelTimers"]
+        # Order sync only sees new orders before the daily cancel sweep when it
+        # runs intraday; the end-of-day run is too late to arm a timer.
+        if "IntradaySync" not in self.get_market_calendar():
+            raise ValueError("OrderCancelTimers requires MarketCalendar IntradaySync")
+
+        pattern_lambda_role_name = self.template.add_parameter(
+            Parameter(
+                "StocksPatternLambdaRoleName",
+                Type="AWS::SSM::Parameter::Value<String>",
+                Default=self.ssm_path("/pattern/lambda/role/name"),
             )
         )
-        self.template.add_resource(cancel_orders_scheduler)
+
+        # One-time schedules are created at run time, one per order, and fire a
+        # targeted cancel at the order's deadline. Creators should set
+        # ActionAfterCompletion=DELETE so fired timers clean themselves up.
+        order_cancel_timer_group = self.template.add_resource(
+            scheduler.ScheduleGroup(
+                "OrderCancelTimerScheduleGroup",
+                Name=order_cancel_timers["ScheduleGroupName"],
+            )
+        )
+
+        timer_execution_role = self.template.add_resource(
+            iam.Role(
+                "OrderCancelTimerExecutionRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "scheduler.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                            "Condition": {
+                                "StringEquals": {
+                                    "aws:SourceAccount": Ref("AWS::AccountId")
+                                }
+                            },
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName="OrderCancelTimerExecutionPolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["lambda:InvokeFunction"],
+                                    "Resource": [
+                                        GetAtt(
+                                            self.stocks_cancel_lambda_function, "Arn"
+                                        )
+                                    ],
+                                },
+                            ],
+                        },
+                    )
+                ],
+            )
+        )
+
+        dead_letter_config = self.create_schedule_dead_letter_queue(
+            "OrderCancelTimer", timer_execution_role
+        )
+
+        self.template.add_resource(
+            iam.ManagedPolicy(
+                "OrderCancelTimerCreatorPolicy",
+                Roles=[
+                    Ref(self.order_sync_lambda_role),
+                    Ref(pattern_lambda_role_name),
+                ]
+                + order_cancel_timers.get("CreatorRoleNames", []),
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Action": [
+                                "scheduler:CreateSchedule",
+                                "scheduler:GetSchedule",
+                                "scheduler:UpdateSchedule",
+                                "scheduler:DeleteSchedule",
+                            ],
+                            "Resource": [
+                                Sub(
+                                    "arn:aws:scheduler:${AWS::Region}:${AWS::AccountId}:schedule/${GroupName}/*",
+                                    GroupName=Ref(order_cancel_timer_group),
+                                )
+                            ],
+                        },
+                        {
+                            "Effect": "Allow",
+                            "Action": ["iam:PassRole"],
+                            "Resource": [GetAtt(timer_execution_role, "Arn")],
+                            "Condition": {
+                                "StringEquals": {
+                                    "iam:PassedToService": "scheduler.amazonaws.com"
+                                }
+                            },
+                        },
+                        {
+                            "Effect": "Allow",
+                            "Action": [
+                                "ssm:GetParameter",
+                                "ssm:GetParameters",
+                                "ssm:GetParametersByPath",
+                            ],
+                            "Resource": [
+                                Sub(
+                                    "arn:aws:ssm:${AWS::Region}:${AWS::AccountId}:parameter${Path}",
+                                    Path=self.ssm_path("/order/cancel/timer"),
+                                ),
+                                Sub(
+                                    "arn:aws:ssm:${AWS::Region}:${AWS::AccountId}:parameter${Path}/*",
+                                    Path=self.ssm_path("/order/cancel/timer"),
+                                ),
+                            ],
+                        },
+                    ],
+                },
+            )
+        )
+
+        order_cancel_timer_settings = {
+            "ORDER_CANCEL_TIMER_GROUP": (
+                "/order/cancel/timer/group/name",
+                Ref(order_cancel_timer_group),
+            ),
+            "ORDER_CANCEL_TIMER_TARGET_ARN": (
+                "/order/cancel/timer/target/arn",
+                GetAtt(self.stocks_cancel_lambda_function, "Arn"),
+            ),
+            "ORDER_CANCEL_TIMER_ROLE_ARN": (
+                "/order/cancel/timer/role/arn",
+                GetAtt(timer_execution_role, "Arn"),
+            ),
+            "ORDER_CANCEL_TIMER_DEAD_LETTER_ARN": (
+                "/order/cancel/timer/dead/letter/arn",
+                dead_letter_config.Arn,
+            ),
+        }
+
+        # The pattern Lambda places orders and arms their timers from these SSM
+        # settings; intraday order sync arms any it missed.
+        for variable, (path, value) in order_cancel_timer_settings.items():
+            self.stocks_order_sync_lambda_function.Environment.Variables[
+                variable
+            ] = value
+            self.template.add_resource(
+                ssm.Parameter(
+                    "".join(part.title() for part in variable.split("_"))
+                    + "Parameter",
+                    Name=self.ssm_path(path),
+                    Type="String",
+                    Value=value,
+                )
+            )
 
     def create_template(self):
         self.get_existing_stocks_bucket()
+        self.create_market_schedule_group()
+        if self.uses_cache_network():
+            self.get_cache_network()
+        if self.get_variables()["env-dict"].get("RateLimiterEnabled", False):
+            self.get_rate_limiter()
+        if "DataLakeTables" in self.get_variables()["env-dict"]:
+            self.get_data_lake_streams()
         self.create_stocks_order_sync_lambda()
         self.create_order_sync_scheduler()
         self.create_stock_profit_calculator_lambda()
         self.create_profit_calculator_scheduler()
         self.create_stocks_cancel_lambda()
         self.create_stocks_cancel_scheduler()
+        if "ExportLambdaName" in self.get_variables()["env-dict"]:
+            self.create_stocks_export_lambda()
+        if "OrderCancelTimers" in self.get_variables()["env-dict"]:
+            self.create_order_cancel_timers()
         return self.template
@@ -1,27 +1,234 @@
-from stacker.blueprints.base import Blueprint
 from troposphere import (
+    Output,
     Ref,
     GetAtt,
     iam,
     awslambda,
-    Parameter,
+    events,
+    kinesis,
+    sqs,
+    ssm,
     Sub,
     apigateway,
 )
 
+from functions import StocksFunctions
 
-class Stocks(Blueprint):
-    VARIABLES = {"env-dict": {"type": dict}}
 
-    def get_existing_stocks_bucket(self):
-        self.existing_stocks_bucket = self.template.add_parameter(
-            Parameter(
-                "StockS3Bucket",
-                Type="String",
-                Default=self.get_variables()["env-dict"]["BucketName"],
+class Stocks(StocksFunctions):
+    def create_signal_stream(self):
+        self.signal_stream = self.template.add_resource(
+            kinesis.Stream(
+                "StocksSignalStream",
+                Name=self.get_variables()["env-dict"]["SignalStreamName"],
+                StreamModeDetails=kinesis.StreamModeDetails(StreamMode="ON_DEMAND"),
+                RetentionPeriodHours=self.get_variables()["env-dict"].get(
+                    "SignalStreamRetentionHours", 24
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "SignalStreamArn",
+                Value=GetAtt(self.signal_stream, "Arn"),
+            )
+        )
+
+    def create_signal_stream_consumers(self):
+        for consumer in self.get_variables()["env-dict"].get(
+            "SignalStreamConsumers", []
+        ):
+            consumer_id = "".join(part.title() for part in consumer["Name"].split("-"))
+
+            # Each registered consumer gets its own enhanced fan-out pipe so it
+            # reads at full shard throughput without competing with the others.
+            stream_consumer = self.template.add_resource(
+                kinesis.StreamConsumer(
+                    f"{consumer_id}SignalStreamConsumer",
+                    ConsumerName=consumer["Name"],
+                    StreamARN=GetAtt(self.signal_stream, "Arn"),
+                )
+            )
+
+            event_source_mapping = awslambda.EventSourceMapping(
+                f"{consumer_id}SignalStreamEventSourceMapping",
+                EventSourceArn=GetAtt(stream_consumer, "ConsumerARN"),
+                FunctionName=consumer["FunctionName"],
+                StartingPosition=consumer.get("StartingPosition", "LATEST"),
+                BatchSize=consumer.get("BatchSize", 100),
+                ParallelizationFactor=consumer.get("ParallelizationFactor", 1),
+                MaximumBatchingWindowInSeconds=consumer.get(
+                    "MaximumBatchingWindowInSeconds", 0
+                ),
+            )
+
+            if "RoleName" in consumer:
+                consumer_policy = self.template.add_resource(
+                    iam.PolicyType(
+                        f"{consumer_id}SignalStreamConsumerPolicy",
+                        PolicyName=f"{consumer_id}SignalStreamConsumerPolicy",
+                        Roles=[consumer["RoleName"]],
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "kinesis:DescribeStream",
+                                        "kinesis:DescribeStreamSummary",
+                                        "kinesis:GetRecords",
+                                        "kinesis:GetShardIterator",
+                                        "kinesis:ListShards",
+                                    ],
+                                    "Resource": [GetAtt(self.signal_stream, "Arn")],
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "kinesis:DescribeStreamConsumer",
+                                        "kinesis:SubscribeToShard",
+                                    ],
+                                    "Resource": [
+                                        GetAtt(stream_consumer, "ConsumerARN")
+                                    ],
+                                },
+                            ],
+                        },
+                    )
+                )
+                event_source_mapping.DependsOn = consumer_policy
+
+            self.template.add_resource(event_source_mapping)
+
+    def create_signal_bus(self):
+        self.signal_bus = self.template.add_resource(
+            events.EventBus(
+                "StocksSignalBus",
+                Name=self.get_variables()["env-dict"]["SignalBusName"],
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "SignalBusArn",
+                Value=GetAtt(self.signal_bus, "Arn"),
             )
         )
 
+    def create_signal_bus_rules(self):
+        for rule in self.get_variables()["env-dict"].get("SignalBusRules", []):
+            rule_id = "".join(part.title() for part in rule["Name"].split("-"))
+
+            event_pattern = {
+                "source": ["stocks.webhook"],
+                "detail-type": ["pattern.detected"],
+            }
+            if "Symbols" in rule:
+                event_pattern.setdefault("detail", {})["symbol"] = rule["Symbols"]
+            if "PatternTypes" in rule:
+                event_pattern.setdefault("detail", {})["pattern"] = rule["PatternTypes"]
+
+            if "ArchiveRetentionDays" in rule:
+                self.template.add_resource(
+                    events.Archive(
+                        f"{rule_id}SignalArchive",
+                        ArchiveName=rule["Name"],
+                        SourceArn=GetAtt(self.signal_bus, "Arn"),
+                        EventPattern=event_pattern,
+                        RetentionDays=rule["ArchiveRetentionDays"],
+                    )
+                )
+
+            # Replayed events carry a replay-name. Rules that act on the market,
+            # like order placement, ignore them unless they opt in.
+            rule_event_pattern = dict(event_pattern)
+            if not rule.get("ReceiveReplays", False):
+                rule_event_pattern["replay-name"] = [{"exists": False}]
+
+            signal_rule = events.Rule(
+                f"{rule_id}SignalRule",
+                Name=rule["Name"],
+                EventBusName=Ref(self.signal_bus),
+                EventPattern=rule_event_pattern,
+                State="ENABLED",
+                Targets=[],
+            )
+
+            for target in rule["Targets"]:
+                target_id = "".join(
+                    part.title() for part in target["FunctionName"].split("-")
+                )
+                function_arn = Sub(
+                    "arn:aws:lambda:${AWS::Region}:${AWS::AccountId}:function:${FunctionName}",
+                    FunctionName=target["FunctionName"],
+                )
+
+                dead_letter_queue = self.template.add_resource(
+                    sqs.Queue(
+                        f"{rule_id}{target_id}DeadLetterQueue",
+                        MessageRetentionPeriod=1209600,
+                        SqsManagedSseEnabled=True,
+                    )
+                )
+                self.template.add_resource(
+                    sqs.QueuePolicy(
+                        f"{rule_id}{target_id}DeadLetterQueuePolicy",
+                        Queues=[Ref(dead_letter_queue)],
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Principal": {"Service": "events.amazonaws.com"},
+                                    "Action": ["sqs:SendMessage"],
+                                    "Resource": [GetAtt(dead_letter_queue, "Arn")],
+                                    "Condition": {
+                                        "ArnEquals": {
+                                            "aws:SourceArn": GetAtt(signal_rule, "Arn")
+                                        }
+                                    },
+                                }
+                            ],
+                        },
+                    )
+                )
+
+                signal_rule.Targets.append(
+                    events.Target(
+                        Id=target["FunctionName"],
+                        Arn=function_arn,
+                        RetryPolicy=events.RetryPolicy(
+                            MaximumRetryAttempts=target.get("MaximumRetryAttempts", 2),
+                            MaximumEventAgeInSeconds=target.get(
+                                "MaximumEventAgeInSeconds", 3600
+                            ),
+                        ),
+                        DeadLetterConfig=events.DeadLetterConfig(
+                            Arn=GetAtt(dead_letter_queue, "Arn")
+                        ),
+                    )
+                )
+
+                self.template.add_resource(
+                    awslambda.Permission(
+                        f"{rule_id}{target_id}InvokePermission",
+                        Action="lambda:InvokeFunction",
+                        FunctionName=target["FunctionName"],
+                        Principal="events.amazonaws.com",
+                        SourceArn=GetAtt(signal_rule, "Arn"),
+                    )
+                )
+
+                self.template.add_output(
+                    Output(
+                        f"{rule_id}{target_id}DeadLetterQueueUrl",
+                        Value=Ref(dead_letter_queue),
+                    )
+                )
+
+            self.template.add_resource(signal_rule)
+
     def create_stocks_pattern_lambda(self):
         lambda_role = self.template.add_resource(
             iam.Role(
@@ -102,7 +309,7 @@ class Stocks(Blueprint):
                                     "Action": ["secretsmanager:GetSecretValue"],
                                     "Resource": [
                                         Sub(
-                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-5BII06",
+                                            "arn:aws:secretsmanager:${AWS::Region}:${AWS::AccountId}:secret:${SecretId}-??????",
                                             SecretId=self.get_variables()["env-dict"][
                                                 "SharedSecretsId"
                                             ],
@@ -116,6 +323,84 @@ class Stocks(Blueprint):
             )
         )
 
+        stocks_pattern_lambda_environment = {
+            "SHARED_SECRETS": self.get_variables()["env-dict"]["SharedSecretsId"]
+        }
+
+        if "SignalStreamName" in self.get_variables()["env-dict"]:
+            lambda_role.Policies.append(
+                iam.Policy(
+                    PolicyName="StocksPatternLambdaSignalStreamPolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": ["kinesis:PutRecord", "kinesis:PutRecords"],
+                                "Resource": [GetAtt(self.signal_stream, "Arn")],
+                            }
+                        ],
+                    },
+                )
+            )
+            stocks_pattern_lambda_environment["SIGNAL_STREAM_NAME"] = Ref(
+                self.signal_stream
+            )
+
+        if "SignalBusName" in self.get_variables()["env-dict"]:
+            lambda_role.Policies.append(
+                iam.Policy(
+                    PolicyName="StocksPatternLambdaSignalBusPolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": ["events:PutEvents"],
+                                "Resource": [GetAtt(self.signal_bus, "Arn")],
+                            }
+                        ],
+                    },
+                )
+            )
+            stocks_pattern_lambda_environment["SIGNAL_BUS_NAME"] = Ref(
+                self.signal_bus
+            )
+
+        if "HotDataBucketName" in self.get_variables()["env-dict"]:
+            lambda_role.Policies.append(
+                iam.Policy(
+                    PolicyName="StocksPatternLambdaHotDataPolicy",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": ["s3express:CreateSession"],
+                                "Resource": [
+                                    Sub(
+                                        "arn:aws:s3express:${AWS::Region}:${AWS::AccountId}:bucket/${BucketName}",
+                                        BucketName=self.get_variables()["env-dict"][
+                                            "HotDataBucketName"
+                                        ],
+                                    )
+                                ],
+                            }
+                        ],
+                    },
+                )
+            )
+            stocks_pattern_lambda_environment["HOT_DATA_BUCKET"] = self.get_variables()[
+                "env-dict"
+            ]["HotDataBucketName"]
+
+        # Orders are placed here, so this is where per-order cancel timers are
+        # armed; the jobs stack publishes their settings under this path.
+        if self.get_variables()["env-dict"].get("OrderCancelTimersEnabled", False):
+            stocks_pattern_lambda_environment[
+                "ORDER_CANCEL_TIMER_PARAMETER_PATH"
+            ] = self.ssm_path("/order/cancel/timer")
+
         stocks_pattern_lambda_function = awslambda.Function(
             "StocksPatternLambdaFunction",
             FunctionName=self.get_variables()["env-dict"]["StocksPatternLambdaName"],
@@ -129,23 +414,31 @@ class Stocks(Blueprint):
                 ),
             ),
             Environment=awslambda.Environment(
-                Variables={
-                    "SHARED_SECRETS": self.get_variables()["env-dict"][
-                        "SharedSecretsId"
-                    ]
-                }
+                Variables=stocks_pattern_lambda_environment
             ),
             Timeout=300,
             Handler="handler",
             Runtime="provided.al2023",
             Role=GetAtt(lambda_role, "Arn"),
         )
+        self.attach_shared_resources(lambda_role, stocks_pattern_lambda_function)
+        self.apply_function_settings(lambda_role, stocks_pattern_lambda_function)
         self.template.add_resource(stocks_pattern_lambda_function)
 
+        # The jobs stack grants this role the order cancel timer permissions.
+        self.template.add_resource(
+            ssm.Parameter(
+                "StocksPatternLambdaRoleNameParameter",
+                Name=self.ssm_path("/pattern/lambda/role/name"),
+                Type="String",
+                Value=Ref(lambda_role),
+            )
+        )
+
         self.harmonic_pattern_api_resource = apigateway.Resource(
             "HarmonicPatternResource",
-            ParentId="{{resolve:ssm:/stocks/webhook/resource/id}}",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            ParentId=self.resolve_ssm("/webhook/resource/id"),
+            RestApiId=self.resolve_ssm("/api/id"),
             PathPart="harmonic-pattern",
         )
         self.template.add_resource(self.harmonic_pattern_api_resource)
@@ -156,7 +449,7 @@ class Stocks(Blueprint):
             AuthorizationType="NONE",
             ApiKeyRequired=False,
             HttpMethod="POST",
-            RestApiId="{{resolve:ssm:/stocks/api/id}}",
+            RestApiId=self.resolve_ssm("/api/id"),
             ResourceId=Ref(self.harmonic_pattern_api_resource),
             Integration=apigateway.Integration(
                 IntegrationHttpMethod="POST",
@@ -180,12 +473,26 @@ class Stocks(Blueprint):
                 Principal="apigateway.amazonaws.com",
                 SourceArn=Sub(
                     "arn:aws:execute-api:${AWS::Region}:${AWS::AccountId}:${ApiId}/*/POST/webhook/harmonic-pattern",
-                    ApiId="{{resolve:ssm:/stocks/api/id}}",
+                    ApiId=self.resolve_ssm("/api/id"),
                 ),
             )
         )
 
     def create_template(self):
         self.get_existing_stocks_bucket()
+        if self.uses_cache_network():
+            self.get_cache_network()
+        if self.get_variables()["env-dict"].get("RateLimiterEnabled", False):
+            self.get_rate_limiter()
+        if "DataLakeTables" in self.get_variables()["env-dict"]:
+            self.get_data_lake_streams()
+        if "SignalStreamName" in self.get_variables()["env-dict"]:
+            self.create_signal_stream()
+        if "SignalBusName" in self.get_variables()["env-dict"]:
+            self.create_signal_bus()
         self.create_stocks_pattern_lambda()
+        if "SignalStreamName" in self.get_variables()["env-dict"]:
+            self.create_signal_stream_consumers()
+        if "SignalBusName" in self.get_variables()["env-dict"]:
+            self.create_signal_bus_rules()
         return self.template
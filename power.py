@@ -0,0 +1,213 @@
+from stacker.blueprints.base import Blueprint
+from troposphere import (
+    Output,
+    Ref,
+    GetAtt,
+    Sub,
+    iam,
+    serverless,
+    stepfunctions,
+)
+
+
+class Stocks(Blueprint):
+    VARIABLES = {"env-dict": {"type": dict}}
+
+    def create_power_tuning_application(self):
+        self.template.set_transform("AWS::Serverless-2016-10-31")
+
+        self.power_tuning_application = self.template.add_resource(
+            serverless.Application(
+                "PowerTuningApplication",
+                Location=serverless.ApplicationLocation(
+                    ApplicationId="arn:aws:serverlessrepo:us-east-1:451282441545:applications/aws-lambda-power-tuning",
+                    SemanticVersion=self.get_variables()["env-dict"].get(
+                        "PowerTuningVersion", "4.3.6"
+                    ),
+                ),
+                Parameters={
+                    "PowerValues": ",".join(
+                        str(power_value)
+                        for power_value in self.get_variables()["env-dict"].get(
+                            "PowerValues", [128, 256, 512, 1024, 1536, 2048, 3008]
+                        )
+                    ),
+                    "lambdaResource": Sub(
+                        "arn:aws:lambda:${AWS::Region}:${AWS::AccountId}:function:stocks-*"
+                    ),
+                },
+            )
+        )
+
+    def create_architecture_tuning_state_machine(self):
+        state_machine_role = self.template.add_resource(
+            iam.Role(
+                "PowerTuningStateMachineRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "states.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName="PowerTuningStateMachinePolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": ["states:StartExecution"],
+                                    "Resource": [
+                                        GetAtt(
+                                            self.power_tuning_application,
+                                            "Outputs.StateMachineARN",
+                                        )
+                                    ],
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "states:DescribeExecution",
+                                        "states:StopExecution",
+                                    ],
+                                    "Resource": "*",
+                                },
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "events:PutTargets",
+                                        "events:PutRule",
+                                        "events:DescribeRule",
+                                    ],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:events:${AWS::Region}:${AWS::AccountId}:rule/StepFunctionsGetEventsForStepFunctionsExecutionRule"
+                                        )
+                                    ],
+                                },
+                            ],
+                        },
+                    )
+                ],
+            )
+        )
+
+        def tune_branch(state_name, architecture):
+            return {
+                "StartAt": state_name,
+                "States": {
+                    state_name: {
+                        "Type": "Task",
+                        "Resource": "arn:aws:states:::states:startExecution.sync:2",
+                        "Parameters": {
+                            "StateMachineArn": "${PowerTuningStateMachineArn}",
+                            "Input": {
+                                "lambdaARN.$": f"$.functionArns.{architecture}",
+                                "num.$": "$.num",
+                                "payload.$": "$.payload",
+                                "parallelInvocation": False,
+                                "strategy.$": "$.strategy",
+                            },
+                        },
+                        "ResultSelector": {
+                            "architecture": architecture,
+                            "power.$": "$.Output.power",
+                            "cost.$": "$.Output.cost",
+                            "duration.$": "$.Output.duration",
+                            "visualization.$": "$.Output.stateMachine.visualization",
+                        },
+                        "End": True,
+                    }
+                },
+            }
+
+        # The tuner publishes versions and aliases on whatever it tunes, so it
+        # runs against the x86_64 and arm64 tuning twins of a function rather
+        # than the function itself. The cheaper of the two optimal settings is
+        # returned as the recommendation for FunctionSettings in config.yaml.
+        state_machine = self.template.add_resource(
+            stepfunctions.StateMachine(
+                "ArchitectureTuningStateMachine",
+                StateMachineName="stocks-power-tuning"
+                + self.get_variables()["env-dict"].get("NameSuffix", ""),
+                RoleArn=GetAtt(state_machine_role, "Arn"),
+                DefinitionSubstitutions={
+                    "PowerTuningStateMachineArn": GetAtt(
+                        self.power_tuning_application, "Outputs.StateMachineARN"
+                    ),
+                    "FunctionArnPrefix": Sub(
+                        "arn:aws:lambda:${AWS::Region}:${AWS::AccountId}:function:"
+                    ),
+                },
+                Definition={
+                    "Comment": "Tune a Stocks Lambda on x86_64 and arm64",
+                    "StartAt": "ResolveFunctions",
+                    "States": {
+                        "ResolveFunctions": {
+                            "Type": "Pass",
+                            "Parameters": {
+                                "x86_64.$": "States.Format('${FunctionArnPrefix}{}-tuning-x86_64', $.functionName)",
+                                "arm64.$": "States.Format('${FunctionArnPrefix}{}-tuning-arm64', $.functionName)",
+                            },
+                            "ResultPath": "$.functionArns",
+                            "Next": "TuneArchitectures",
+                        },
+                        "TuneArchitectures": {
+                            "Type": "Parallel",
+                            "Branches": [
+                                tune_branch("TuneX8664", "x86_64"),
+                                tune_branch("TuneArm64", "arm64"),
+                            ],
+                            "ResultPath": "$.results",
+                            "Next": "CompareArchitectures",
+                        },
+                        "CompareArchitectures": {
+                            "Type": "Choice",
+                            "Choices": [
+                                {
+                                    "Variable": "$.results[0].cost",
+                                    "NumericLessThanEqualsPath": "$.results[1].cost",
+                                    "Next": "RecommendX8664",
+                                }
+                            ],
+                            "Default": "RecommendArm64",
+                        },
+                        "RecommendX8664": {
+                            "Type": "Pass",
+                            "Parameters": {
+                                "functionName.$": "$.functionName",
+                                "recommendation.$": "$.results[0]",
+                                "results.$": "$.results",
+                            },
+                            "End": True,
+                        },
+                        "RecommendArm64": {
+                            "Type": "Pass",
+                            "Parameters": {
+                                "functionName.$": "$.functionName",
+                                "recommendation.$": "$.results[1]",
+                                "results.$": "$.results",
+                            },
+                            "End": True,
+                        },
+                    },
+                },
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "ArchitectureTuningStateMachineArn",
+                Value=Ref(state_machine),
+            )
+        )
+
+    def create_template(self):
+        self.create_power_tuning_application()
+        self.create_architecture_tuning_state_machine()
+        return self.template
@@ -1,24 +1,605 @@
+import json
+
 from stacker.blueprints.base import Blueprint
 from troposphere import (
     Output,
     Ref,
+    GetAtt,
+    Sub,
+    iam,
     s3,
+    s3express,
+    awslambda,
+    dynamodb,
+    glue,
+    firehose,
+    ssm,
 )
 
 
 class Stocks(Blueprint):
     VARIABLES = {"env-dict": {"type": dict}}
 
-    def create_template(self):
-        s3_bucket = s3.Bucket(
+    def ssm_path(self, path):
+        return self.get_variables()["env-dict"].get("SsmPrefix", "/stocks") + path
+
+    def create_stocks_bucket(self):
+        self.s3_bucket = s3.Bucket(
             "StockS3Bucket",
             BucketName=self.get_variables()["env-dict"]["BucketName"],
         )
-        self.template.add_resource(s3_bucket)
+
+        # Noncurrent-version expiry only has versions to expire on a versioned
+        # bucket, so LambdaArtifactNoncurrentDays turns versioning on.
+        env_dict = self.get_variables()["env-dict"]
+        bucket_versioning = env_dict.get(
+            "BucketVersioning", "LambdaArtifactNoncurrentDays" in env_dict
+        )
+        if "LambdaArtifactNoncurrentDays" in env_dict and not bucket_versioning:
+            raise ValueError(
+                "LambdaArtifactNoncurrentDays requires BucketVersioning: true"
+            )
+
+        if bucket_versioning:
+            self.s3_bucket.VersioningConfiguration = s3.VersioningConfiguration(
+                Status="Enabled"
+            )
+
+        lifecycle_rules = self.get_bucket_lifecycle_rules(bucket_versioning)
+        if lifecycle_rules:
+            self.s3_bucket.LifecycleConfiguration = s3.LifecycleConfiguration(
+                Rules=lifecycle_rules
+            )
+
+        if "IntelligentTiering" in self.get_variables()["env-dict"]:
+            intelligent_tiering = self.get_variables()["env-dict"]["IntelligentTiering"]
+            tierings = [
+                s3.Tiering(
+                    AccessTier="ARCHIVE_ACCESS",
+                    Days=intelligent_tiering.get("ArchiveAccessDays", 90),
+                )
+            ]
+            if "DeepArchiveAccessDays" in intelligent_tiering:
+                tierings.append(
+                    s3.Tiering(
+                        AccessTier="DEEP_ARCHIVE_ACCESS",
+                        Days=intelligent_tiering["DeepArchiveAccessDays"],
+                    )
+                )
+            self.s3_bucket.IntelligentTieringConfigurations = [
+                s3.IntelligentTieringConfiguration(
+                    Id="StocksIntelligentTiering",
+                    Prefix=intelligent_tiering.get("Prefix", "data/"),
+                    Status="Enabled",
+                    Tierings=tierings,
+                )
+            ]
+
+        if "BucketNotifications" in self.get_variables()["env-dict"] or (
+            self.get_variables()["env-dict"].get("BucketEventBridgeEnabled", False)
+        ):
+            self.s3_bucket.NotificationConfiguration = (
+                self.get_bucket_notification_configuration()
+            )
+
+        self.template.add_resource(self.s3_bucket)
 
         self.template.add_output(
             Output(
                 "BucketName",
-                Value=Ref(s3_bucket),
+                Value=Ref(self.s3_bucket),
+            )
+        )
+
+    def get_bucket_lifecycle_rules(self, bucket_versioning):
+        env_dict = self.get_variables()["env-dict"]
+        lifecycle_rules = []
+
+        # Versioning applies to the whole bucket, so every overwrite or delete
+        # leaves a noncurrent version behind. This rule bounds how long they are
+        # kept; where it overlaps the lambdas/ rule below, S3 applies whichever
+        # expires first.
+        if bucket_versioning:
+            lifecycle_rules.append(
+                s3.LifecycleRule(
+                    Id="ExpireNoncurrentVersions",
+                    Status="Enabled",
+                    NoncurrentVersionExpiration=s3.NoncurrentVersionExpiration(
+                        NoncurrentDays=env_dict.get("NoncurrentVersionDays", 90),
+                    ),
+                )
             )
-        )
\ No newline at end of file
+
+        if "LambdaArtifactNoncurrentDays" in env_dict:
+            lifecycle_rules.append(
+                s3.LifecycleRule(
+                    Id="ExpireNoncurrentLambdaArtifacts",
+                    Prefix="lambdas/",
+                    Status="Enabled",
+                    NoncurrentVersionExpiration=s3.NoncurrentVersionExpiration(
+                        NoncurrentDays=env_dict["LambdaArtifactNoncurrentDays"],
+                        NewerNoncurrentVersions=env_dict.get(
+                            "LambdaArtifactRetainedVersions", 3
+                        ),
+                    ),
+                    AbortIncompleteMultipartUpload=s3.AbortIncompleteMultipartUpload(
+                        DaysAfterInitiation=7
+                    ),
+                )
+            )
+
+        if "ColdDataTransitionDays" in env_dict:
+            lifecycle_rules.append(
+                s3.LifecycleRule(
+                    Id="TransitionColdData",
+                    Prefix=env_dict.get("ColdDataPrefix", "data/"),
+                    Status="Enabled",
+                    Transitions=[
+                        s3.LifecycleRuleTransition(
+                            StorageClass=env_dict.get(
+                                "ColdDataStorageClass", "INTELLIGENT_TIERING"
+                            ),
+                            TransitionInDays=env_dict["ColdDataTransitionDays"],
+                        )
+                    ],
+                    AbortIncompleteMultipartUpload=s3.AbortIncompleteMultipartUpload(
+                        DaysAfterInitiation=7
+                    ),
+                )
+            )
+
+        return lifecycle_rules
+
+    def get_bucket_notification_configuration(self):
+        lambda_configurations = []
+        queue_configurations = []
+        topic_configurations = []
+        invoke_permissions = []
+
+        for notification in self.get_variables()["env-dict"].get(
+            "BucketNotifications", []
+        ):
+            notification_kwargs = {"Event": notification["Event"]}
+            filter_rules = [
+                s3.Rules(Name=name.lower(), Value=notification[name])
+                for name in ["Prefix", "Suffix"]
+                if name in notification
+            ]
+            if filter_rules:
+                notification_kwargs["Filter"] = s3.Filter(
+                    S3Key=s3.S3Key(Rules=filter_rules)
+                )
+
+            if "FunctionArn" in notification:
+                notification_id = "".join(
+                    part.title() for part in notification["Name"].split("-")
+                )
+                # The permission uses the bucket name rather than a reference to
+                # the bucket so S3 can validate the target while the bucket is
+                # still being created.
+                invoke_permission = self.template.add_resource(
+                    awslambda.Permission(
+                        f"{notification_id}BucketInvokePermission",
+                        Action="lambda:InvokeFunction",
+                        FunctionName=notification["FunctionArn"],
+                        Principal="s3.amazonaws.com",
+                        SourceAccount=Ref("AWS::AccountId"),
+                        SourceArn=Sub(
+                            "arn:aws:s3:::${BucketName}",
+                            BucketName=self.get_variables()["env-dict"]["BucketName"],
+                        ),
+                    )
+                )
+                invoke_permissions.append(invoke_permission)
+                lambda_configurations.append(
+                    s3.LambdaConfigurations(
+                        Function=notification["FunctionArn"], **notification_kwargs
+                    )
+                )
+            elif "QueueArn" in notification:
+                queue_configurations.append(
+                    s3.QueueConfigurations(
+                        Queue=notification["QueueArn"], **notification_kwargs
+                    )
+                )
+            elif "TopicArn" in notification:
+                topic_configurations.append(
+                    s3.TopicConfigurations(
+                        Topic=notification["TopicArn"], **notification_kwargs
+                    )
+                )
+
+        if invoke_permissions:
+            self.s3_bucket.DependsOn = invoke_permissions
+
+        notification_configuration = s3.NotificationConfiguration()
+        if self.get_variables()["env-dict"].get("BucketEventBridgeEnabled", False):
+            notification_configuration.EventBridgeConfiguration = (
+                s3.EventBridgeConfiguration(EventBridgeEnabled=True)
+            )
+        if lambda_configurations:
+            notification_configuration.LambdaConfigurations = lambda_configurations
+        if queue_configurations:
+            notification_configuration.QueueConfigurations = queue_configurations
+        if topic_configurations:
+            notification_configuration.TopicConfigurations = topic_configurations
+        return notification_configuration
+
+    def create_express_bucket(self):
+        # Directory bucket names must carry the zone suffix, e.g.
+        # stocks-hot--usw2-az1--x-s3.
+        express_bucket = self.template.add_resource(
+            s3express.DirectoryBucket(
+                "StockS3ExpressBucket",
+                BucketName=Sub(
+                    "${BucketName}--${AvailabilityZoneId}--x-s3",
+                    BucketName=self.get_variables()["env-dict"]["ExpressBucketName"],
+                    AvailabilityZoneId=self.get_variables()["env-dict"][
+                        "ExpressAvailabilityZoneId"
+                    ],
+                ),
+                DataRedundancy="SingleAvailabilityZone",
+                LocationName=self.get_variables()["env-dict"][
+                    "ExpressAvailabilityZoneId"
+                ],
+                LifecycleConfiguration=s3express.LifecycleConfiguration(
+                    Rules=[
+                        s3express.Rule(
+                            Id="ExpireHotData",
+                            Status="Enabled",
+                            ExpirationInDays=self.get_variables()["env-dict"].get(
+                                "ExpressExpirationDays", 1
+                            ),
+                        )
+                    ]
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "ExpressBucketName",
+                Value=Ref(express_bucket),
+            )
+        )
+
+    def create_rate_limiter_table(self):
+        # One item per broker endpoint class. Callers take tokens with a
+        # conditional UpdateItem, so every function shares the same budget.
+        rate_limiter_table = self.template.add_resource(
+            dynamodb.Table(
+                "BrokerRateLimiterTable",
+                TableName=self.get_variables()["env-dict"]["RateLimiterTableName"],
+                BillingMode="PAY_PER_REQUEST",
+                AttributeDefinitions=[
+                    dynamodb.AttributeDefinition(
+                        AttributeName="bucket",
+                        AttributeType="S",
+                    )
+                ],
+                KeySchema=[
+                    dynamodb.KeySchema(
+                        AttributeName="bucket",
+                        KeyType="HASH",
+                    )
+                ],
+            )
+        )
+
+        self.template.add_resource(
+            ssm.Parameter(
+                "RateLimiterTableNameParameter",
+                Name=self.ssm_path("/rate/limiter/table/name"),
+                Type="String",
+                Value=Ref(rate_limiter_table),
+            )
+        )
+
+        self.template.add_resource(
+            ssm.Parameter(
+                "RateLimiterTableArnParameter",
+                Name=self.ssm_path("/rate/limiter/table/arn"),
+                Type="String",
+                Value=GetAtt(rate_limiter_table, "Arn"),
+            )
+        )
+
+        self.template.add_resource(
+            ssm.Parameter(
+                "RateLimiterBucketsParameter",
+                Name=self.ssm_path("/rate/limiter/buckets"),
+                Type="String",
+                Value=json.dumps(
+                    self.get_variables()["env-dict"]["RateLimiterBuckets"],
+                    separators=(",", ":"),
+                    sort_keys=True,
+                ),
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "RateLimiterTableName",
+                Value=Ref(rate_limiter_table),
+            )
+        )
+
+    def create_data_lake_database(self):
+        self.data_lake_database = self.template.add_resource(
+            glue.Database(
+                "StocksDataLakeDatabase",
+                CatalogId=Ref("AWS::AccountId"),
+                DatabaseInput=glue.DatabaseInput(
+                    Name=self.get_variables()["env-dict"]["DataLakeDatabaseName"],
+                    Description="Stocks market event data lake",
+                ),
+            )
+        )
+
+        self.data_lake_delivery_role = self.template.add_resource(
+            iam.Role(
+                "StocksDataLakeDeliveryRole",
+                AssumeRolePolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {
+                            "Effect": "Allow",
+                            "Principal": {"Service": "firehose.amazonaws.com"},
+                            "Action": "sts:AssumeRole",
+                        }
+                    ],
+                },
+                Policies=[
+                    iam.Policy(
+                        PolicyName="StocksDataLakeDeliveryS3Policy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "s3:AbortMultipartUpload",
+                                        "s3:GetBucketLocation",
+                                        "s3:GetObject",
+                                        "s3:ListBucket",
+                                        "s3:ListBucketMultipartUploads",
+                                        "s3:PutObject",
+                                    ],
+                                    "Resource": [
+                                        GetAtt(self.s3_bucket, "Arn"),
+                                        Sub(
+                                            "${BucketArn}/data/*",
+                                            BucketArn=GetAtt(self.s3_bucket, "Arn"),
+                                        ),
+                                    ],
+                                }
+                            ],
+                        },
+                    ),
+                    iam.Policy(
+                        PolicyName="StocksDataLakeDeliveryGluePolicy",
+                        PolicyDocument={
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Effect": "Allow",
+                                    "Action": [
+                                        "glue:GetTable",
+                                        "glue:GetTableVersion",
+                                        "glue:GetTableVersions",
+                                    ],
+                                    "Resource": [
+                                        Sub(
+                                            "arn:aws:glue:${AWS::Region}:${AWS::AccountId}:catalog"
+                                        ),
+                                        Sub(
+                                            "arn:aws:glue:${AWS::Region}:${AWS::AccountId}:database/${DatabaseName}",
+                                            DatabaseName=Ref(self.data_lake_database),
+                                        ),
+                                        Sub(
+                                            "arn:aws:glue:${AWS::Region}:${AWS::AccountId}:table/${DatabaseName}/*",
+                                            DatabaseName=Ref(self.data_lake_database),
+                                        ),
+                                    ],
+                                }
+                            ],
+                        },
+                    ),
+                ],
+            )
+        )
+
+        self.template.add_output(
+            Output(
+                "DataLakeDatabaseName",
+                Value=Ref(self.data_lake_database),
+            )
+        )
+
+    def create_data_lake_tables(self):
+        for table in self.get_variables()["env-dict"]["DataLakeTables"]:
+            table_id = "".join(part.title() for part in table["Name"].split("_"))
+            table_location = Sub(
+                "s3://${BucketName}/data/${TableName}/",
+                BucketName=Ref(self.s3_bucket),
+                TableName=table["Name"],
+            )
+
+            # Partition projection lets Athena compute the dt/symbol partitions
+            # from the query predicates instead of listing them from the catalog,
+            # so only the prefixes a query actually touches are scanned. Symbols
+            # are projected from the table's Symbols list so queries across
+            # symbols still work; tables without one are partitioned by dt only.
+            table_parameters = {
+                "classification": "parquet",
+                "parquet.compression": "SNAPPY",
+                "projection.enabled": "true",
+                "projection.dt.type": "date",
+                "projection.dt.format": "yyyy-MM-dd",
+                "projection.dt.range": table.get("ProjectionStartDate", "2024-01-01")
+                + ",NOW",
+                "projection.dt.interval": "1",
+                "projection.dt.interval.unit": "DAYS",
+                "storage.location.template": Sub(
+                    "s3://${BucketName}/data/${TableName}/dt=${!dt}/",
+                    BucketName=Ref(self.s3_bucket),
+                    TableName=table["Name"],
+                ),
+            }
+            partition_keys = [glue.Column(Name="dt", Type="string")]
+            delivery_prefix = "data/${TableName}/dt=!{timestamp:yyyy-MM-dd}/"
+            if "Symbols" in table:
+                table_parameters["projection.symbol.type"] = "enum"
+                table_parameters["projection.symbol.values"] = ",".join(
+                    table["Symbols"]
+                )
+                table_parameters["storage.location.template"] = Sub(
+                    "s3://${BucketName}/data/${TableName}/dt=${!dt}/symbol=${!symbol}/",
+                    BucketName=Ref(self.s3_bucket),
+                    TableName=table["Name"],
+                )
+                partition_keys.append(glue.Column(Name="symbol", Type="string"))
+                delivery_prefix += "symbol=!{partitionKeyFromQuery:symbol}/"
+
+            data_lake_table = self.template.add_resource(
+                glue.Table(
+                    f"{table_id}DataLakeTable",
+                    CatalogId=Ref("AWS::AccountId"),
+                    DatabaseName=Ref(self.data_lake_database),
+                    TableInput=glue.TableInput(
+                        Name=table["Name"],
+                        TableType="EXTERNAL_TABLE",
+                        Parameters=table_parameters,
+                        PartitionKeys=partition_keys,
+                        StorageDescriptor=glue.StorageDescriptor(
+                            Columns=[
+                                glue.Column(Name=column["Name"], Type=column["Type"])
+                                for column in table["Columns"]
+                            ],
+                            Location=table_location,
+                            InputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                            OutputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                            SerdeInfo=glue.SerdeInfo(
+                                SerializationLibrary="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
+                            ),
+                        ),
+                    ),
+                )
+            )
+
+            delivery_stream = self.template.add_resource(
+                firehose.DeliveryStream(
+                    f"{table_id}DataLakeDeliveryStream",
+                    DeliveryStreamName=Sub(
+                        "stocks-${TableName}-delivery-stream${NameSuffix}",
+                        TableName=table["Name"].replace("_", "-"),
+                        NameSuffix=self.get_variables()["env-dict"].get("NameSuffix", ""),
+                    ),
+                    DeliveryStreamType="DirectPut",
+                    ExtendedS3DestinationConfiguration=firehose.ExtendedS3DestinationConfiguration(
+                        BucketARN=GetAtt(self.s3_bucket, "Arn"),
+                        RoleARN=GetAtt(self.data_lake_delivery_role, "Arn"),
+                        Prefix=Sub(delivery_prefix, TableName=table["Name"]),
+                        ErrorOutputPrefix=Sub(
+                            "data/errors/${TableName}/!{firehose:error-output-type}/dt=!{timestamp:yyyy-MM-dd}/",
+                            TableName=table["Name"],
+                        ),
+                        # Parquet conversion needs at least a 64 MB buffer; larger
+                        # buffers mean fewer, bigger objects for Athena to open.
+                        BufferingHints=firehose.BufferingHints(
+                            SizeInMBs=table.get("BufferSizeInMBs", 128),
+                            IntervalInSeconds=table.get("BufferIntervalInSeconds", 300),
+                        ),
+                        CompressionFormat="UNCOMPRESSED",
+                        DataFormatConversionConfiguration=firehose.DataFormatConversionConfiguration(
+                            Enabled=True,
+                            InputFormatConfiguration=firehose.InputFormatConfiguration(
+                                Deserializer=firehose.Deserializer(
+                                    OpenXJsonSerDe=firehose.OpenXJsonSerDe()
+                                )
+                            ),
+                            OutputFormatConfiguration=firehose.OutputFormatConfiguration(
+                                Serializer=firehose.Serializer(
+                                    ParquetSerDe=firehose.ParquetSerDe(
+                                        Compression="SNAPPY"
+                                    )
+                                )
+                            ),
+                            SchemaConfiguration=firehose.SchemaConfiguration(
+                                CatalogId=Ref("AWS::AccountId"),
+                                DatabaseName=Ref(self.data_lake_database),
+                                TableName=Ref(data_lake_table),
+                                Region=Ref("AWS::Region"),
+                                RoleARN=GetAtt(self.data_lake_delivery_role, "Arn"),
+                                VersionId="LATEST",
+                            ),
+                        ),
+                    ),
+                )
+            )
+
+            if "Symbols" in table:
+                delivery_destination = delivery_stream.ExtendedS3DestinationConfiguration
+                delivery_destination.DynamicPartitioningConfiguration = (
+                    firehose.DynamicPartitioningConfiguration(
+                        Enabled=True,
+                        RetryOptions=firehose.RetryOptions(DurationInSeconds=300),
+                    )
+                )
+                delivery_destination.ProcessingConfiguration = (
+                    firehose.ProcessingConfiguration(
+                        Enabled=True,
+                        Processors=[
+                            firehose.Processor(
+                                Type="MetadataExtraction",
+                                Parameters=[
+                                    firehose.ProcessorParameter(
+                                        ParameterName="MetadataExtractionQuery",
+                                        ParameterValue="{symbol: .symbol}",
+                                    ),
+                                    firehose.ProcessorParameter(
+                                        ParameterName="JsonParsingEngine",
+                                        ParameterValue="JQ-1.6",
+                                    ),
+                                ],
+                            )
+                        ],
+                    )
+                )
+
+            # Producers in the lambdas and jobs stacks look the stream up here.
+            self.template.add_resource(
+                ssm.Parameter(
+                    f"{table_id}DeliveryStreamNameParameter",
+                    Name=self.ssm_path(f"/data/lake/{table['Name']}/delivery/stream/name"),
+                    Type="String",
+                    Value=Ref(delivery_stream),
+                )
+            )
+
+            self.template.add_resource(
+                ssm.Parameter(
+                    f"{table_id}DeliveryStreamArnParameter",
+                    Name=self.ssm_path(f"/data/lake/{table['Name']}/delivery/stream/arn"),
+                    Type="String",
+                    Value=GetAtt(delivery_stream, "Arn"),
+                )
+            )
+
+            self.template.add_output(
+                Output(
+                    f"{table_id}DeliveryStreamName",
+                    Value=Ref(delivery_stream),
+                )
+            )
+
+    def create_template(self):
+        self.create_stocks_bucket()
+        if "ExpressBucketName" in self.get_variables()["env-dict"]:
+            self.create_express_bucket()
+        if "RateLimiterTableName" in self.get_variables()["env-dict"]:
+            self.create_rate_limiter_table()
+        if "DataLakeDatabaseName" in self.get_variables()["env-dict"]:
+            self.create_data_lake_database()
+            self.create_data_lake_tables()
+        return self.template
@@ -0,0 +1,405 @@
+"""Replay captured harmonic-pattern alerts against the webhook.
+
+Alerts are read from a JSONL file (one webhook body per line) and sent in
+phases of RATE:SECONDS[:BURST]. Each phase opens with BURST requests at once
+and then holds RATE requests per second. Sends are open loop: a slow backend
+does not slow the offered load.
+
+Without --url the alerts go to a local stand-in for API Gateway. It turns each
+request into an AWS_PROXY event, answered by a stub with --handler-latency-ms
+or posted to a Lambda Runtime Interface Emulator given with --lambda-url.
+
+The stand-in follows the deployed contract: the webhook method has
+ApiKeyRequired=False, so the usage plan throttle never applies to it. Pass
+--api-key-required to model the method with an API key and the usage plan
+throttle from integrations.py (50 rps, 100 burst) instead.
+
+    python tools/webhook_replay.py --alerts alerts.jsonl --phase 50:30 --phase 50:10:100
+    python tools/webhook_replay.py --alerts alerts.jsonl --phase 50:30 \\
+        --url https://<api-id>.execute-api.us-west-2.amazonaws.com/api/webhook/harmonic-pattern
+
+Each run is compared against the last saved run for the same target in the
+baseline file. Pass --save-baseline to replace it.
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBHOOK_PATH = "/webhook/harmonic-pattern"
+STAGE_NAME = "api"
+
+# Usage plan throttle in integrations.py.
+USAGE_PLAN_RATE = 50
+USAGE_PLAN_BURST = 100
+
+REPORT_KEYS = [
+    "throughput",
+    "latency_p50_ms",
+    "latency_p95_ms",
+    "latency_p99_ms",
+    "throttles",
+    "errors",
+]
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def build_proxy_event(handler, body):
+    path, _, query = handler.path.partition("?")
+    headers = {name: value for name, value in handler.headers.items()}
+    query_parameters = {}
+    for pair in filter(None, query.split("&")):
+        name, _, value = pair.partition("=")
+        query_parameters.setdefault(name, []).append(value)
+
+    return {
+        "resource": WEBHOOK_PATH,
+        "path": path,
+        "httpMethod": handler.command,
+        "headers": headers,
+        "multiValueHeaders": {name: [value] for name, value in headers.items()},
+        "queryStringParameters": (
+            {name: values[-1] for name, values in query_parameters.items()}
+            if query_parameters
+            else None
+        ),
+        "multiValueQueryStringParameters": query_parameters or None,
+        "pathParameters": None,
+        "stageVariables": None,
+        "requestContext": {
+            "resourcePath": WEBHOOK_PATH,
+            "httpMethod": handler.command,
+            "path": f"/{STAGE_NAME}{path}",
+            "stage": STAGE_NAME,
+            "requestId": str(uuid.uuid4()),
+            "requestTimeEpoch": int(time.time() * 1000),
+            "protocol": handler.request_version,
+            "identity": {
+                "apiKey": handler.headers.get("x-api-key"),
+                "sourceIp": handler.client_address[0],
+                "userAgent": handler.headers.get("User-Agent"),
+            },
+        },
+        "body": body.decode("utf-8"),
+        "isBase64Encoded": False,
+    }
+
+
+def make_stand_in_handler(args):
+    usage_plan_buckets = {}
+    usage_plan_lock = threading.Lock()
+
+    def usage_plan_bucket(api_key):
+        with usage_plan_lock:
+            if api_key not in usage_plan_buckets:
+                usage_plan_buckets[api_key] = TokenBucket(
+                    args.throttle_rate, args.throttle_burst
+                )
+            return usage_plan_buckets[api_key]
+
+    def invoke(event):
+        if not args.lambda_url:
+            time.sleep(args.handler_latency_ms / 1000)
+            return {"statusCode": 200, "body": json.dumps({"message": "ok"})}
+
+        request = urllib.request.Request(
+            args.lambda_url,
+            data=json.dumps(event).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            return json.loads(response.read())
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            pass
+
+        def respond(self, status_code, body, headers=None):
+            payload = body.encode("utf-8")
+            self.send_response(status_code)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.partition("?")[0] != WEBHOOK_PATH:
+                self.respond(403, json.dumps({"message": "Missing Authentication Token"}))
+                return
+
+            if args.api_key_required:
+                api_key = self.headers.get("x-api-key")
+                if not api_key:
+                    self.respond(403, json.dumps({"message": "Forbidden"}))
+                    return
+                if not usage_plan_bucket(api_key).take():
+                    self.respond(429, json.dumps({"message": "Too Many Requests"}))
+                    return
+
+            try:
+                result = invoke(build_proxy_event(self, body))
+            except (OSError, ValueError):
+                self.respond(502, json.dumps({"message": "Internal server error"}))
+                return
+
+            # A malformed proxy response is a 502 at API Gateway as well.
+            if not isinstance(result, dict) or "statusCode" not in result:
+                self.respond(502, json.dumps({"message": "Internal server error"}))
+                return
+
+            response_body = result.get("body") or ""
+            if result.get("isBase64Encoded"):
+                response_body = base64.b64decode(response_body).decode("utf-8")
+            self.respond(result["statusCode"], response_body, result.get("headers"))
+
+    return StandInHandler
+
+
+class StandInServer(ThreadingHTTPServer):
+    # Bursts arrive faster than the default backlog of 5 can be accepted.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_stand_in(args):
+    server = StandInServer(("127.0.0.1", 0), make_stand_in_handler(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}{WEBHOOK_PATH}"
+
+
+def parse_phase(value):
+    parts = value.split(":")
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(f"expected RATE:SECONDS[:BURST], got {value}")
+    try:
+        rate, seconds = float(parts[0]), float(parts[1])
+        burst = int(parts[2]) if len(parts) == 3 else 0
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected RATE:SECONDS[:BURST], got {value}")
+    if rate < 0 or seconds <= 0 or burst < 0:
+        raise argparse.ArgumentTypeError(f"expected RATE:SECONDS[:BURST], got {value}")
+    return rate, seconds, burst
+
+
+def load_alerts(path):
+    with open(path) as alerts_file:
+        alerts = [line.strip() for line in alerts_file if line.strip()]
+    for line_number, alert in enumerate(alerts, start=1):
+        try:
+            json.loads(alert)
+        except ValueError:
+            sys.exit(f"{path}:{line_number}: not a JSON alert")
+    if not alerts:
+        sys.exit(f"{path}: no alerts to replay")
+    return alerts
+
+
+def schedule_sends(phases):
+    send_offsets = []
+    phase_start = 0.0
+    for rate, seconds, burst in phases:
+        send_offsets.extend([phase_start] * burst)
+        for index in range(int(rate * seconds)):
+            send_offsets.append(phase_start + index / rate)
+        phase_start += seconds
+    return send_offsets
+
+
+def send_alert(url, api_key, alert, timeout):
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["x-api-key"] = api_key
+    request = urllib.request.Request(
+        url, data=alert.encode("utf-8"), headers=headers, method="POST"
+    )
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        error.read()
+        status = error.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return status, (time.perf_counter() - started) * 1000
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return round(sorted_values[rank - 1], 2)
+
+
+def replay(url, args, alerts):
+    send_offsets = schedule_sends(args.phase)
+    results = []
+    results_lock = threading.Lock()
+
+    def send(index):
+        status, latency_ms = send_alert(
+            url, args.api_key, alerts[index % len(alerts)], args.timeout
+        )
+        with results_lock:
+            results.append((status, latency_ms))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for index, offset in enumerate(send_offsets):
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, index)
+    elapsed = time.perf_counter() - started
+
+    # Throttled and failed requests are reported on their own so a faster
+    # 429 cannot pull the latency percentiles down.
+    latencies = sorted(
+        latency_ms
+        for status, latency_ms in results
+        if status is not None and status < 400
+    )
+    status_counts = {}
+    for status, _ in results:
+        status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+
+    return {
+        "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "phases": [f"{rate:g}:{seconds:g}:{burst}" for rate, seconds, burst in args.phase],
+        "sent": len(send_offsets),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+        "throttles": status_counts.get("429", 0),
+        "errors": sum(
+            count
+            for status, count in status_counts.items()
+            if status == "None" or int(status) >= 500
+        ),
+        "status_counts": status_counts,
+    }
+
+
+def print_report(target, report, baseline):
+    print(f"target: {target}")
+    print(f"phases: {' '.join(report['phases'])}")
+    print(f"sent: {report['sent']} in {report['elapsed_seconds']}s")
+    print(f"status: {json.dumps(report['status_counts'], sort_keys=True)}")
+    for key in REPORT_KEYS:
+        line = f"{key}: {report[key]}"
+        if baseline is not None and baseline.get(key) is not None and report[key] is not None:
+            delta = report[key] - baseline[key]
+            line += f" (baseline {baseline[key]}, {delta:+.2f})"
+        print(line)
+    if baseline is not None:
+        print(f"baseline recorded at {baseline['recorded_at']}")
+        if baseline["phases"] != report["phases"]:
+            print("warning: baseline was recorded with different phases")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--alerts", required=True, help="JSONL file of webhook bodies")
+    parser.add_argument(
+        "--phase",
+        action="append",
+        type=parse_phase,
+        required=True,
+        help="RATE:SECONDS[:BURST], repeatable",
+    )
+    parser.add_argument("--url", help="deployed webhook URL; local stand-in if unset")
+    parser.add_argument(
+        "--api-key",
+        default=os.environ.get("STOCKS_API_KEY"),
+        help="x-api-key header (default $STOCKS_API_KEY, or a fixed key locally with --api-key-required)",
+    )
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--baseline", default="webhook-replay-baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+
+    stand_in = parser.add_argument_group("local stand-in")
+    stand_in.add_argument("--lambda-url", help="Runtime Interface Emulator invoke URL")
+    stand_in.add_argument("--handler-latency-ms", type=float, default=20)
+    stand_in.add_argument(
+        "--api-key-required",
+        action="store_true",
+        help="require an API key and apply the usage plan throttle",
+    )
+    stand_in.add_argument("--throttle-rate", type=float, default=USAGE_PLAN_RATE)
+    stand_in.add_argument("--throttle-burst", type=int, default=USAGE_PLAN_BURST)
+    args = parser.parse_args()
+
+    alerts = load_alerts(args.alerts)
+
+    if args.url:
+        target, url = args.url, args.url
+    else:
+        server, url = start_stand_in(args)
+        target = f"local:{args.lambda_url or 'stub'}"
+        if args.api_key_required:
+            target += ":api-key-required"
+            args.api_key = args.api_key or "local-replay-key"
+
+    report = replay(url, args, alerts)
+
+    if not args.url:
+        server.shutdown()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    print_report(target, report, baselines.get(target))
+
+    if args.save_baseline:
+        baselines[target] = report
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"saved baseline for {target} to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()